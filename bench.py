@@ -0,0 +1,157 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import mmr
+import ranks
+
+class FakeUser:
+    def __init__(self, name, nick=None) -> None:
+        self.name = name
+        self.nick = nick
+        self.id = hash(name)
+
+    def __repr__(self) -> str:
+        return self.name
+
+def role_mix(kind, n):
+    match kind:
+        case 'fill':
+            return [[] for _ in range(n)]
+        case 'mixed':
+            return [random.sample(mmr.ROLES, random.randint(0, 2)) for _ in range(n)]
+        case 'primary':
+            return [[mmr.ROLES[i % len(mmr.ROLES)]] for i in range(n)]
+        case 'impossible':
+            # nobody can play anything but top, so no split works and every one gets checked
+            return [['top'] for _ in range(n)]
+
+def mmr_distribution(kind, n):
+    match kind:
+        case 'normal':
+            return [random.gauss(1200, 250) for _ in range(n)]
+        case 'uniform':
+            return [random.uniform(600, 2200) for _ in range(n)]
+        case 'flat':
+            return [1200.0] * n
+
+async def make_queue(ratings, n, roles, distribution):
+    users = [FakeUser(f'player{i}', f'nick{i}' if i % 2 else None) for i in range(n)]
+    def insert(conn):
+        conn.executemany('INSERT OR REPLACE INTO mmr (name, mmr) VALUES (?, ?)',
+                         [(user.name, rating) for user, rating in zip(users, mmr_distribution(distribution, n))])
+    await ratings.db.write(insert)
+    await ratings.load_cache()
+    return list(zip(users, map(mmr.preference, role_mix(roles, n))))
+
+def time_it(fun, runs, setup=None):
+    times = []
+    result = None
+    for _ in range(runs):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        result = fun()
+        times.append(time.perf_counter() - start)
+    return times, result
+
+def percentile(times, p):
+    times = sorted(times)
+    return times[min(int(len(times) * p), len(times) - 1)]
+
+def imbalance(teams):
+    if not teams:
+        return None
+    return abs(teams[0][1] - teams[1][1]) / 5
+
+def cold():
+    # role assignments are cached across calls, every run starts without them so a slower solver shows up. the feasibility
+    # table is built once at startup and stays
+    mmr.assign_roles.cache_clear()
+
+async def run(args):
+    ratings = mmr.Ratings(':memory:')
+    mmr.feasible_table()
+    results = {}
+    # checks that failed outright, whatever the timings
+    failed = []
+    def record(name, times, result=None):
+        results[name] = {'p50': percentile(times, .5) * 1000, 'p99': percentile(times, .99) * 1000, 'imbalance': result}
+    for roles in ['fill', 'mixed', 'primary', 'impossible']:
+        queued = await make_queue(ratings, mmr.GAME_SIZE, roles, args.distribution)
+        for fun in [mmr.Matchmaking.balanced, mmr.Matchmaking.random]:
+            times, teams = time_it(lambda: mmr.Matchmaking(ratings, queued).matchmake(fun), args.runs, cold)
+            record(f'{fun.__name__}/{roles}', times, imbalance(teams))
+        preferences = dict(queued)
+        times, _ = time_it(lambda: mmr.is_valid_team([user for user, _ in queued[:5]], preferences), args.runs, cold)
+        record(f'is_valid_team/{roles}', times)
+    for size in [20, 40]:
+        queued = await make_queue(ratings, size, 'mixed', args.distribution)
+        times, games = time_it(lambda: mmr.Matchmaking(ratings, queued).matchmake_batch(), args.runs, cold)
+        record(f'batch/{size}', times, max((imbalance(teams) for teams in games), default=None))
+    # three players that can only play top in the middle of the mmr order, so only lobbies leaving one of them out work
+    queued = await make_queue(ratings, mmr.GAME_SIZE + 1, 'fill', args.distribution)
+    middle = {user for user, _ in sorted(queued, key=lambda user: ratings.cached_mmr(user[0].name))[4:7]}
+    queued = [(user, mmr.preference(['top']) if user in middle else roles) for user, roles in queued]
+    times, games = time_it(lambda: mmr.Matchmaking(ratings, queued).matchmake_batch(), args.runs, cold)
+    record('batch/stuck', times, max((imbalance(teams) for teams in games), default=None))
+    if not games:
+        failed.append('batch/stuck made no game')
+    mmrs = [(f'player{i}', rating) for i, rating in enumerate(mmr_distribution(args.distribution, args.players))]
+    times, _ = time_it(lambda: ranks.map_ranks(mmrs), args.runs)
+    record(f'map_ranks/{args.players}', times)
+    for tiers, percentiles in [('absolute', None), ('percentile', ranks.PERCENTILES)]:
+        index = ranks.RankIndex(mmrs, percentiles)
+        times, _ = time_it(lambda: index.apply({name: random.uniform(-50, 50) for name, _ in random.sample(mmrs, mmr.GAME_SIZE)}), args.runs)
+        record(f'rank_index_apply/{tiers}/{args.players}', times)
+    queued = await make_queue(ratings, mmr.GAME_SIZE, 'fill', args.distribution)
+    teams = mmr.Matchmaking(ratings, queued).matchmake(mmr.Matchmaking.balanced)
+    # a new game each run, since a game only renders its card once
+    times, _ = time_it(lambda: str(mmr.Game(ratings, teams[0][0], teams[1][0], teams[0][1], teams[1][1], teams[0][2], teams[1][2])), args.runs)
+    record('game_str', times)
+    return results, failed
+
+def report(results, baseline, tolerance):
+    failed = []
+    print(f'{"benchmark":<28}{"p50 ms":>10}{"p99 ms":>10}{"imbalance":>11}')
+    for name, result in results.items():
+        imbalance = '' if result['imbalance'] is None else f'{result["imbalance"]:.1f}'
+        line = f'{name:<28}{result["p50"]:>10.3f}{result["p99"]:>10.3f}{imbalance:>11}'
+        if old := baseline.get(name):
+            if result['p99'] > old['p99'] * tolerance:
+                line += f'  slower than baseline ({old["p99"]:.3f} ms)'
+                failed.append(name)
+            if result['imbalance'] is not None and old['imbalance'] is not None and result['imbalance'] > old['imbalance'] * tolerance + 1:
+                line += f'  less balanced than baseline ({old["imbalance"]:.1f})'
+                failed.append(name)
+        print(line)
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description='times matchmaking, rank mapping and game rendering on synthetic queues')
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--players', type=int, default=5000, help='number of rated players for the rank benchmarks')
+    parser.add_argument('--distribution', choices=['normal', 'uniform', 'flat'], default='normal')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the results to this file to use as a baseline later')
+    parser.add_argument('--baseline', help='fail if any benchmark regresses past the results in this file')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='how many times slower than the baseline is still a pass')
+    args = parser.parse_args()
+    random.seed(args.seed)
+    results, failed = asyncio.run(run(args))
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    failed += report(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    if failed:
+        print(f'regressed: {", ".join(failed)}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+class Database:
+    # all sqlite work for one file runs on a single thread so the event loop never waits on disk
+    def __init__(self, path, migrations=()) -> None:
+        self.path = path
+        self.migrations = migrations
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, isolation_level=None)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.migrate()
+        return self.conn
+
+    def migrate(self):
+        # migrations[i] brings the schema from user_version i to i + 1, as a script or a function of the connection
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        for i, script in enumerate(self.migrations[version:], version + 1):
+            if callable(script):
+                # migrations that need python, like backfilling from the game log, get the connection in a transaction
+                self.conn.execute('BEGIN')
+                script(self.conn)
+                self.conn.execute(f'PRAGMA user_version = {i}')
+                self.conn.execute('COMMIT')
+            else:
+                self.conn.executescript(f'BEGIN;\n{script}\nPRAGMA user_version = {i};\nCOMMIT;')
+
+    def _read(self, fun, args):
+        return fun(self.connect(), *args)
+
+    def _write(self, fun, args):
+        # the write that opens a transaction queues its commit on the thread, so every write that was already waiting behind
+        # it shares the commit and nothing stays uncommitted for longer than one pass over the queue. writes that get
+        # cancelled before they run never open one
+        conn = self.connect()
+        if not conn.in_transaction:
+            conn.execute('BEGIN')
+            self.executor.submit(self._commit)
+        conn.execute('SAVEPOINT write')
+        try:
+            return fun(conn, *args)
+        except:
+            conn.execute('ROLLBACK TO write')
+            raise
+        finally:
+            conn.execute('RELEASE write')
+
+    def _commit(self):
+        if self.conn.in_transaction:
+            self.conn.execute('COMMIT')
+
+    async def read(self, fun, *args):
+        # timed from the event loop's side, so time spent waiting behind other work on the thread counts too
+        with metrics.timer('db_seconds', op='read'):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, self._read, fun, args)
+
+    async def write(self, fun, *args):
+        with metrics.timer('db_seconds', op='write'):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, self._write, fun, args)
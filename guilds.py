@@ -0,0 +1,84 @@
+import json
+import os
+import mmr
+from lobby import Lobby
+from status import QueueStatus
+
+# the guild the bot was originally run in keeps using the original database file
+LEGACY_GUILD_ID = int(guild_id) if (guild_id := os.getenv('GUILD_ID')) else None
+QUEUE_PER_CHANNEL = os.getenv('QUEUE_PER_CHANNEL') == '1'
+
+class GuildState:
+    # everything one guild owns, so guilds never share a queue, a rating table or a database file
+    def __init__(self, guild_id) -> None:
+        self.guild_id = guild_id
+        self.ratings = mmr.Ratings('bot.db' if guild_id == LEGACY_GUILD_ID else f'bot-{guild_id}.db')
+        self.lobbies = {}
+        # name -> the lobby a player is queued, held or playing in, across every lobby
+        self.lobby_of = {}
+        self.statuses = {}
+        self.rank_index = None
+        self.leaderboard = None
+        self.role_sync = None
+        self.members = None
+
+    def lobby(self, channel):
+        key = channel.id if QUEUE_PER_CHANNEL else None
+        if key not in self.lobbies:
+            self.lobbies[key] = Lobby(mmr.MatchmakingType.balanced, key, self.lobby_of)
+        return self.lobbies[key]
+
+    def status(self, channel, render):
+        if channel.id not in self.statuses:
+            self.statuses[channel.id] = QueueStatus(channel, render)
+        return self.statuses[channel.id]
+
+    async def save(self, *lobbies):
+        # a lobby is a few rows at most, so it's rewritten whole on every change and a restart gets back exactly what was there
+        rows = [(lobby.key or 0, json.dumps(lobby.dump())) for lobby in lobbies]
+        def write(conn):
+            conn.executemany('INSERT INTO lobbies (lobby, state) VALUES (?, ?) ON CONFLICT (lobby) DO UPDATE SET state = excluded.state', rows)
+        await self.ratings.db.write(write)
+
+    async def restore(self):
+        def read(conn):
+            return conn.execute('SELECT lobby, state FROM lobbies').fetchall()
+        await self.ratings.get_cache()
+        resolve = self.members.get if self.members else lambda name, id: None
+        for key, state in await self.ratings.db.read(read):
+            key = key or None
+            # a lobby someone already queued into while the guild was loading wins over the saved one
+            if key not in self.lobbies:
+                self.lobbies[key] = Lobby.load(key, json.loads(state), self.ratings, resolve, self.lobby_of)
+
+    def member(self, name):
+        if self.members:
+            return self.members.get(name, self.ratings.ids.get(name))
+        return None
+
+    def player_name(self, user):
+        return self.ratings.names.get(user.id, user.name)
+
+    def rename(self, old_name, name):
+        # gives the lobby the player was in, if any, so it can be saved
+        if (lobby := self.lobby_of.get(old_name)) is not None and lobby.rename(old_name, name):
+            return lobby
+        return None
+
+    def game_of(self, user):
+        if (lobby := self.lobby_of.get(user.name)) is not None and (game := lobby.game_of(user)):
+            return lobby, game
+        return None, None
+
+    def held_game(self, user):
+        # a lobby with nobody queued is falsy
+        if (lobby := self.lobby_of.get(user.name)) is not None:
+            return lobby.held_game(user)
+        return None
+
+states = {}
+
+def state(guild):
+    if guild.id not in states:
+        states[guild.id] = GuildState(guild.id)
+    return states[guild.id]
@@ -0,0 +1,38 @@
+import math
+import discord
+from utils import get_display_name
+
+PAGE_SIZE = 20
+
+class Leaderboard:
+    # rendered pages are kept until the ratings change, so showing a page doesn't sort anything
+    def __init__(self, rank_index, resolve) -> None:
+        self.rank_index = rank_index
+        self.resolve = resolve
+        self.ranking = None
+        self.pages = {}
+
+    def invalidate(self):
+        self.ranking = None
+        self.pages.clear()
+
+    def refresh(self):
+        self.ranking = [(name, mmr) for mmr, name in reversed(self.rank_index.order)]
+
+    def page_count(self):
+        if self.ranking is None:
+            self.refresh()
+        return max(math.ceil(len(self.ranking) / PAGE_SIZE), 1)
+
+    def page(self, index):
+        index = min(max(index, 1), self.page_count())
+        if index not in self.pages:
+            lines = []
+            for i, (name, mmr) in enumerate(self.ranking[(index - 1) * PAGE_SIZE:index * PAGE_SIZE], (index - 1) * PAGE_SIZE + 1):
+                if member := self.resolve(name):
+                    name = get_display_name(member)
+                lines.append(f'{i:2d}: {discord.utils.escape_markdown(name)} ({mmr:.0f})')
+            embed = discord.Embed(title='Leaderboard', description='\n'.join(lines) or 'nobody has played yet')
+            embed.set_footer(text=f'page {index}/{self.page_count()}')
+            self.pages[index] = embed
+        return self.pages[index]
@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import discord
+
+# the bot must not log in when main is imported, and load_dotenv doesn't override what is already set
+os.environ['API_KEY'] = ''
+import guilds
+import main
+import metrics
+import mmr
+import readycheck
+
+# a stand-in for the parts of discord the bot touches, every call goes through FakeApi so it can be slowed down, rate limited
+# and counted
+
+class FakeResponse:
+    def __init__(self, status, reason, retry_after) -> None:
+        self.status = status
+        self.reason = reason
+        self.headers = {'Retry-After': str(retry_after)}
+
+class FakeApi:
+    def __init__(self, latency, rate, rate_limit_chance) -> None:
+        self.latency = latency
+        self.rate = rate
+        self.rate_limit_chance = rate_limit_chance
+        self.calls = collections.Counter()
+        self.rate_limits = collections.Counter()
+        # per route token buckets of (tokens, last refill)
+        self.buckets = {}
+
+    def wait(self, route):
+        # seconds until the route has a call to spare, 0 if it has one now. the call is booked either way, so callers that
+        # have to wait line up behind each other like they do behind discord.py's per route locks
+        if not self.rate:
+            return 0
+        now = time.perf_counter()
+        tokens, last = self.buckets.get(route, (self.rate, now))
+        tokens = min(self.rate, tokens + (now - last) * self.rate) - 1
+        self.buckets[route] = (tokens, now)
+        return max(-tokens / self.rate, 0)
+
+    async def call(self, route, raises=False):
+        # discord.py waits out rate limits by itself for most calls, raises is for the calls the bot handles 429s for itself
+        self.calls[route] += 1
+        if self.latency:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+        wait = self.wait(route)
+        if wait or random.random() < self.rate_limit_chance:
+            self.rate_limits[route] += 1
+            if raises:
+                if wait:
+                    # the call never happened, so it gives its booking back
+                    tokens, last = self.buckets[route]
+                    self.buckets[route] = (tokens + 1, last)
+                raise discord.HTTPException(FakeResponse(429, 'Too Many Requests', max(wait, .1)), 'rate limited')
+            await asyncio.sleep(max(wait, .1))
+
+class FakeRole:
+    def __init__(self, guild, id, name, color, position) -> None:
+        self.guild = guild
+        self.id = id
+        self.name = name
+        self.color = color
+        self.position = position
+        self.permissions = discord.Permissions.membership()
+
+    @property
+    def members(self):
+        return [member for member in self.guild.members if self in member.roles]
+
+    async def edit(self, color):
+        await self.guild.api.call('edit_role')
+        self.color = color
+        return self
+
+    async def delete(self):
+        await self.guild.api.call('delete_role')
+        self.guild.roles.remove(self)
+
+class FakeMember:
+    def __init__(self, guild, id, name, nick=None) -> None:
+        self.guild = guild
+        self.id = id
+        self.name = name
+        self.nick = nick
+        self.roles = []
+        self.mutual_guilds = [guild]
+
+    async def add_roles(self, *roles):
+        await self.guild.api.call('add_roles', raises=True)
+        self.roles += [role for role in roles if role not in self.roles]
+
+    async def remove_roles(self, *roles):
+        await self.guild.api.call('remove_roles', raises=True)
+        self.roles = [role for role in self.roles if role not in roles]
+
+class FakeGuild:
+    def __init__(self, api, id, players) -> None:
+        self.api = api
+        self.id = id
+        self.default_role = FakeRole(self, id, '@everyone', discord.Color.default(), 0)
+        self.roles = [self.default_role]
+        self.members = [FakeMember(self, 1000 + i, f'player{i}', f'nick{i}' if i % 3 == 0 else None) for i in range(players)]
+        self.by_id = {member.id: member for member in self.members}
+
+    def get_member(self, id):
+        return self.by_id.get(id)
+
+    def get_member_named(self, name):
+        return next((member for member in self.members if member.name == name), None)
+
+    async def create_role(self, name, color, **_):
+        await self.api.call('create_role')
+        role = FakeRole(self, len(self.roles) + 1, name, color, len(self.roles))
+        self.roles.append(role)
+        return role
+
+    async def edit_role_positions(self, positions):
+        await self.api.call('edit_role_positions')
+        for role, position in positions.items():
+            role.position = position
+
+class FakeInteractionResponse:
+    def __init__(self, api) -> None:
+        self.api = api
+
+    async def edit_message(self, **_):
+        await self.api.call('interaction_response')
+
+    async def defer(self):
+        await self.api.call('interaction_response')
+
+    async def send_message(self, *_, **__):
+        await self.api.call('interaction_response')
+
+class FakeInteraction:
+    def __init__(self, api, user) -> None:
+        self.user = user
+        self.response = FakeInteractionResponse(api)
+
+class FakeMessage:
+    def __init__(self, channel) -> None:
+        self.channel = channel
+
+    async def edit(self, **_):
+        await self.channel.api.call('edit_message')
+
+    async def add_reaction(self, _):
+        await self.channel.api.call('add_reaction')
+
+class FakeChannel:
+    def __init__(self, api, id, on_view) -> None:
+        self.api = api
+        self.id = id
+        self.on_view = on_view
+
+    async def send(self, content=None, view=None, **_):
+        await self.api.call('send_message')
+        if view:
+            self.on_view(view)
+        return FakeMessage(self)
+
+class FakeContext:
+    def __init__(self, guild, channel, author) -> None:
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.message = FakeMessage(channel)
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    async def send_help(self, *_):
+        pass
+
+class Driver:
+    # plays thousands of players: queueing, leaving, answering ready checks and reporting results
+    def __init__(self, args, api) -> None:
+        self.args = args
+        self.api = api
+        self.guild = FakeGuild(api, 10 ** 17 + args.seed, args.players)
+        self.channel = FakeChannel(api, 1, self.ready_check)
+        self.commands = collections.Counter()
+        self.errors = collections.Counter()
+        self.ready_checks = collections.Counter()
+        self.presses = set()
+
+    def ready_check(self, view):
+        if not isinstance(view, readycheck.ReadyCheck):
+            return
+        self.ready_checks['started'] += 1
+        loop = asyncio.get_running_loop()
+        for member in view.players.values():
+            roll = random.random()
+            if roll < self.args.afk:
+                continue
+            button = view.decline if roll < self.args.afk + self.args.decline else view.accept
+            loop.call_later(random.uniform(0, self.args.ready_timeout / 2), self.press, view, button, member)
+        # what the view's own timeout would do once it is listening for interactions
+        loop.call_later(self.args.ready_timeout, view.stop)
+
+    def press(self, view, button, member):
+        if not view.is_finished():
+            task = asyncio.create_task(button.callback(FakeInteraction(self.api, member)))
+            self.presses.add(task)
+            task.add_done_callback(self.presses.discard)
+
+    def traffic(self):
+        if self.args.script:
+            with open(self.args.script) as file:
+                # one command per line: player number, command, arguments
+                for line in file:
+                    if line.strip() and not line.startswith('#'):
+                        player, command, *args = line.split()
+                        yield self.guild.members[int(player)], command, args
+            return
+        state = guilds.state(self.guild)
+        for _ in range(self.args.commands):
+            member = random.choice(self.guild.members)
+            lobby, game = state.game_of(member)
+            if game:
+                yield member, random.choice(['blue', 'red']), []
+            elif state.lobby(self.channel).queued(member) and random.random() > self.args.leave:
+                continue
+            else:
+                yield member, 'queue', random.sample(mmr.ROLES, random.choice([0, 0, 1, 2]))
+
+    async def run_command(self, member, command, args):
+        ctx = FakeContext(self.guild, self.channel, member)
+        start = time.perf_counter()
+        try:
+            await main.bot.get_command(command)(ctx, *args)
+            status = 'ok'
+        except Exception:
+            status = 'failed'
+            if not self.errors[command]:
+                logging.getLogger(__name__).exception('%s %s failed, only its first failure is shown', command, args)
+            self.errors[command] += 1
+        metrics.observe('command_seconds', time.perf_counter() - start, command=command, status=status)
+        self.commands[command] += 1
+
+    async def run(self):
+        await main.setup_guild(self.guild)
+        main.bot.get_channel = {self.channel.id: self.channel}.get
+        main.SCHEDULE_INTERVAL = self.args.schedule_interval
+        schedule = asyncio.create_task(main.schedule())
+        traffic = self.traffic()
+        async def worker():
+            for member, command, args in traffic:
+                await self.run_command(member, command, args)
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(self.args.concurrency)])
+        elapsed = time.perf_counter() - start
+        # let the last ready checks and role updates finish before reporting
+        await asyncio.sleep(self.args.ready_timeout)
+        await asyncio.wait_for(guilds.state(self.guild).role_sync.join(), self.args.drain_timeout)
+        schedule.cancel()
+        return elapsed
+
+def report(driver, elapsed):
+    total = sum(driver.commands.values())
+    state = guilds.state(driver.guild)
+    print(f'{total} commands in {elapsed:.2f}s, {total / elapsed:.0f} commands/s')
+    print(f'commands: {dict(driver.commands)}, errors: {dict(driver.errors)}')
+    print(f'ready checks: {driver.ready_checks["started"]}, games running: {sum(len(lobby.games) for lobby in state.lobbies.values())}, '
+          f'queued: {sum(len(lobby) for lobby in state.lobbies.values())}')
+    print(f'api calls: {sum(driver.api.calls.values())} {dict(driver.api.calls)}')
+    print(f'rate limited: {sum(driver.api.rate_limits.values())} {dict(driver.api.rate_limits)}')
+    for line in metrics.summary():
+        print(line)
+
+async def run(args):
+    api = FakeApi(args.latency, args.rate, args.rate_limit_chance)
+    await metrics.start()
+    async with main.bot:
+        driver = Driver(args, api)
+        elapsed = await driver.run()
+    report(driver, elapsed)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='drives the bot\'s commands against a local fake of discord')
+    parser.add_argument('--players', type=int, default=2000)
+    parser.add_argument('--commands', type=int, default=10000, help='number of random commands to send')
+    parser.add_argument('--script', help='file of "player command args" lines to replay instead of random traffic')
+    parser.add_argument('--concurrency', type=int, default=200, help='commands in flight at once')
+    parser.add_argument('--latency', type=float, default=.05, help='mean seconds per api call')
+    parser.add_argument('--rate', type=float, default=50, help='api calls per second allowed per route, 0 for no limit')
+    parser.add_argument('--rate-limit-chance', type=float, default=0, help='chance any api call gets a 429 anyway')
+    parser.add_argument('--leave', type=float, default=.1, help='chance a queued player picked again leaves the queue')
+    parser.add_argument('--decline', type=float, default=.02, help='chance a player declines a ready check')
+    parser.add_argument('--afk', type=float, default=.02, help='chance a player never answers a ready check')
+    parser.add_argument('--ready-timeout', type=float, default=2)
+    parser.add_argument('--schedule-interval', type=float, default=1)
+    parser.add_argument('--drain-timeout', type=float, default=60, help='seconds to wait for role updates to finish')
+    parser.add_argument('--dir', help='where the guild database goes, a new temporary directory by default')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    random.seed(args.seed)
+    os.chdir(args.dir or tempfile.mkdtemp(prefix='loadtest-'))
+    asyncio.run(run(args))
+    sys.exit(0)
@@ -0,0 +1,154 @@
+import time
+import mmr
+
+class Lobby:
+    # the queue and the games being played, indexed by player name so every lookup is a dict hit
+    def __init__(self, mode, key=None, lobby_of=None) -> None:
+        self.mode = mode
+        self.key = key
+        # name -> lobby for every player queued, held or playing, shared by all of a guild's lobbies so a player is only
+        # ever in one of them
+        self.lobby_of = {} if lobby_of is None else lobby_of
+        # the channel games are announced in, the one the last player queued from
+        self.channel_id = None
+        self.queue = {}
+        self.joined = {}
+        self.players = {}
+        self.games = {}
+        # games waiting on their ready check, with what their players need to go back in the queue, and the other way
+        self.held = {}
+        self.holding = {}
+
+    def __len__(self):
+        return len(self.queue)
+
+    def queued(self, user):
+        return user.name in self.queue
+
+    def in_game(self, user):
+        return user.name in self.players
+
+    def game_of(self, user):
+        return self.players.get(user.name)
+
+    def held_game(self, user):
+        return self.holding.get(user.name)
+
+    def queued_users(self):
+        return list(self.queue.values())
+
+    def waits(self, now):
+        return {name: now - joined for name, joined in self.joined.items()}
+
+    def join(self, user, roles, joined=None):
+        self.queue[user.name] = (user, roles)
+        self.joined.setdefault(user.name, joined or time.time())
+        self.lobby_of[user.name] = self
+
+    def forget(self, name):
+        if self.lobby_of.get(name) is self:
+            del self.lobby_of[name]
+
+    def leave(self, user):
+        if self.queue.pop(user.name, None):
+            self.forget(user.name)
+        self.joined.pop(user.name, None)
+
+    def clear(self):
+        for name in self.queue:
+            self.forget(name)
+        self.queue.clear()
+        self.joined.clear()
+
+    def hold(self, game):
+        # takes a matched game's players out of the queue until they all accept it
+        entries = []
+        for user in game.blue_team + game.red_team:
+            user, roles = self.queue.pop(user.name)
+            entries.append((user, roles, self.joined.pop(user.name, None)))
+            self.holding[user.name] = game
+        self.held[game] = entries
+
+    def release(self, game, dropped):
+        # players that missed the ready check leave, the rest go back in front of everyone with the time they joined
+        front = {}
+        for user, roles, joined in self.held.pop(game, []):
+            self.holding.pop(user.name, None)
+            if user.name not in dropped:
+                front[user.name] = (user, roles)
+                self.joined[user.name] = joined or time.time()
+            else:
+                self.forget(user.name)
+        self.queue = front | self.queue
+
+    def start_game(self, game):
+        for user, _, _ in self.held.pop(game, []):
+            self.holding.pop(user.name, None)
+        self.games[game] = None
+        for user in game.blue_team + game.red_team:
+            self.queue.pop(user.name, None)
+            self.joined.pop(user.name, None)
+            self.players[user.name] = game
+            self.lobby_of[user.name] = self
+
+    def end_game(self, game):
+        self.games.pop(game, None)
+        for user in game.blue_team + game.red_team:
+            if self.players.get(user.name) is game:
+                del self.players[user.name]
+                self.forget(user.name)
+
+    def rename(self, old_name, name):
+        # everything here is keyed by name, so a player that changed their username is moved over in place, keeping their
+        # spot in the queue. gives whether they were in this lobby at all
+        def rekey(entries):
+            return {name if key == old_name else key: value for key, value in entries.items()}
+        if self.lobby_of.get(old_name) is not self:
+            return False
+        self.lobby_of[name] = self.lobby_of.pop(old_name)
+        self.queue = rekey(self.queue)
+        self.joined = rekey(self.joined)
+        self.players = rekey(self.players)
+        self.holding = rekey(self.holding)
+        for game in list(self.games) + list(self.held):
+            if old_name in game.mmrs:
+                game.mmrs = rekey(game.mmrs)
+                game.card = None
+        return True
+
+    def dump(self):
+        # users are kept as (id, name) and looked up again on load, games as the snapshot they were made from
+        def user(user):
+            return [getattr(user, 'id', None), user.name]
+        return {
+            'mode': self.mode.name,
+            'channel': self.channel_id,
+            # a ready check doesn't survive a restart, its players come back in front of the queue
+            'queue': [[*user(member), roles, joined] for entries in self.held.values() for member, roles, joined in entries] +
+                     [[*user(member), roles, self.joined.get(member.name)] for member, roles in self.queue.values()],
+            'games': [{
+                'blue': [user(member) for member in game.blue_team],
+                'red': [user(member) for member in game.red_team],
+                'blue_roles': game.blue_roles,
+                'red_roles': game.red_roles,
+                'blue_mmr': game.blue_mmr * 5,
+                'red_mmr': game.red_mmr * 5,
+                'mmrs': game.mmrs,
+            } for game in self.games],
+        }
+
+    @classmethod
+    def load(cls, key, state, ratings, resolve, lobby_of=None):
+        # resolve(name, id) gives the member, players that left the guild come back as bare names
+        def user(id, name):
+            return resolve(name, id) or mmr.Player(name)
+        lobby = cls(mmr.MatchmakingType[state['mode']], key, lobby_of)
+        lobby.channel_id = state.get('channel')
+        for id, name, roles, *joined in state['queue']:
+            # queues saved before preferences were stored keep the role names they were joined with
+            roles = mmr.Preference(*roles) if roles and isinstance(roles[0], int) else mmr.preference(roles)
+            lobby.join(user(id, name), roles, *joined)
+        for game in state['games']:
+            lobby.start_game(mmr.Game(ratings, [user(*member) for member in game['blue']], [user(*member) for member in game['red']],
+                                      game['blue_mmr'], game['red_mmr'], game['blue_roles'], game['red_roles'], game['mmrs']))
+        return lobby
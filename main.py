@@ -1,3 +1,4 @@
+import asyncio
 import typing
 import ranks
 import mmr
@@ -7,24 +8,27 @@ import os
 from dotenv import load_dotenv
 import constants
 import random
-import logging
 import time
+import logging
+import metrics
+import rolesync
+import guilds
+import readycheck
+from leaderboard import Leaderboard
+from members import MemberIndex
 from utils import get_display_name
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
-bot = commands.Bot(command_prefix='!', intents=intents, help_command=commands.DefaultHelpCommand(no_category='Commands'), case_insensitive=True)
 load_dotenv()
-GUILD_ID = int(os.getenv('GUILD_ID'))
-if GUILD_ID is None:
-    exit(1)
+# each process can run a subset of the shards, every guild's state lives only in the process that has its shard
+shard_count = int(count) if (count := os.getenv('SHARD_COUNT')) else None
+shard_ids = [int(shard) for shard in ids.split(',')] if (ids := os.getenv('SHARD_IDS')) else None
 
-queue_num = 0
-queued_users = []
-games = []
-matchmaking_mode = mmr.MatchmakingType.balanced 
+bot = commands.AutoShardedBot(command_prefix='!', intents=intents, help_command=commands.DefaultHelpCommand(no_category='Commands'), case_insensitive=True,
+                              shard_count=shard_count, shard_ids=shard_ids)
 
 # @bot.command()
 # async def sync(_):
@@ -42,56 +46,171 @@ async def on_command_error(ctx, err):
     _log.error('Ignoring exception in command %s', command, exc_info=err)
     await ctx.send_help()
 
+@bot.check
+async def guild_only(ctx):
+    return ctx.guild is not None
+
+@bot.before_invoke
+async def start_timer(ctx):
+    ctx.start_time = time.perf_counter()
+
+@bot.after_invoke
+async def stop_timer(ctx):
+    # after_invoke runs for failed commands too, they're kept apart so errors don't skew the latencies
+    metrics.observe('command_seconds', time.perf_counter() - ctx.start_time, command=ctx.command.qualified_name,
+                    status='failed' if ctx.command_failed else 'ok')
+
+def pop_size(lobby):
+    if lobby.mode == mmr.MatchmakingType.batch:
+        return mmr.BATCH_QUEUE_SIZE
+    return mmr.GAME_SIZE
+
+def pop(state, lobby):
+    # matches every game the queue allows right now and holds it for its ready check, gives the games and, if none were made, why
+    if len(lobby) < pop_size(lobby):
+        return [], None
+    waits = None if lobby.mode == mmr.MatchmakingType.random else lobby.waits(time.time())
+    matchmaking = mmr.Matchmaking(state.ratings, lobby.queued_users(), waits)
+    matches = []
+    if len(lobby) > mmr.GAME_SIZE or lobby.mode == mmr.MatchmakingType.batch:
+        matches = matchmaking.matchmake_batch()
+        if not matches:
+            return [], 'no fair game can be made yet, the allowed mmr gap widens the longer the queue waits'
+    else:
+        teams = None
+        match lobby.mode:
+            case mmr.MatchmakingType.balanced:
+                teams = matchmaking.matchmake(mmr.Matchmaking.balanced)
+            case mmr.MatchmakingType.random:
+                teams = matchmaking.matchmake(mmr.Matchmaking.random)
+        if not teams:
+            return [], 'can\'t matchmake with current roles'
+        if not matchmaking.acceptable(teams):
+            return [], f'teams would be {abs(teams[0][1] - teams[1][1]) / 5:.0f} mmr apart, waiting for closer teams or a wider allowed gap'
+        matches.append(teams)
+    new_games = []
+    for teams in matches:
+        game = mmr.Game(state.ratings, teams[0][0], teams[1][0], teams[0][1], teams[1][1], teams[0][2], teams[1][2], matchmaking.mmrs)
+        lobby.hold(game)
+        new_games.append(game)
+    return new_games, None
+
+ready_checks = set()
+
+def start_ready_checks(state, lobby, channel, games):
+    # every game waits on its own players, so any number of ready checks run side by side
+    for game in games:
+        task = asyncio.create_task(ready_check(state, lobby, channel, game))
+        ready_checks.add(task)
+        task.add_done_callback(ready_checks.discard)
+
+async def ready_check(state, lobby, channel, game):
+    try:
+        view = readycheck.ReadyCheck(game)
+        message = await channel.send(game, view=view)
+        timed_out = await view.wait()
+    except Exception as err:
+        logging.getLogger('discord.ext.bot').error('could not run the ready check in %s', channel, exc_info=err)
+        lobby.release(game, [])
+        return
+    if not (missing := view.missing()):
+        lobby.start_game(game)
+        await state.save(lobby)
+        await message.edit(content=f'{game}\neveryone is ready, the game has started', view=None)
+        return
+    dropped = view.dropped(timed_out)
+    lobby.release(game, [user.name for user in dropped])
+    await state.save(lobby)
+    queue_status(state, lobby, channel).touch()
+    names = discord.utils.escape_markdown(', '.join(get_display_name(user) for user in dropped))
+    reason = 'didn\'t accept in time' if timed_out else 'declined'
+    await message.edit(content=f'{game}\n{names} {reason} and left the queue, everyone else is back at the front of it', view=None)
+    new_games, _ = pop(state, lobby)
+    start_ready_checks(state, lobby, channel, new_games)
+
+def describe_queue(lobby):
+    user_strs = [get_display_name(user[0]) + f" ({mmr.describe(user[1])})" for user in lobby.queued_users()]
+    return f"{len(lobby):2d}/{pop_size(lobby)} currently in queue: {', '.join(user_strs)}"
+
+def queue_status(state, lobby, channel):
+    return state.status(channel, lambda: describe_queue(lobby))
+
+async def acknowledge(ctx, emoji):
+    try:
+        metrics.count('discord_api_calls_total', call='add_reaction')
+        await ctx.message.add_reaction(emoji)
+    except discord.HTTPException:
+        pass
+
+SCHEDULE_INTERVAL = 5
+# a teammate needs this many games together to count among a player's best duos
+DUO_MIN_GAMES = 5
+
+async def schedule():
+    # every queue is looked at again every few seconds, so games that weren't close enough get made as the allowed gap widens
+    while True:
+        await asyncio.sleep(SCHEDULE_INTERVAL)
+        for state in list(guilds.states.values()):
+            for lobby in list(state.lobbies.values()):
+                if len(lobby) < pop_size(lobby) or not (channel := bot.get_channel(lobby.channel_id)):
+                    continue
+                try:
+                    new_games, _ = pop(state, lobby)
+                    if new_games:
+                        queue_status(state, lobby, channel).touch()
+                        start_ready_checks(state, lobby, channel, new_games)
+                except Exception as err:
+                    logging.getLogger('discord.ext.bot').error('could not pop the queue in %s', channel, exc_info=err)
+
+scheduler = None
+
 @bot.command(
         help='''joins/leaves the queue
-        when 10 are in queue a game is made
+        when 10 are in queue a game is made, and it starts once all 10 accept it
         if you are not in the database, queueing adds you to it
-        you can also specify roles to queue for
+        you can also specify roles to queue for, the first one is your primary role and the rest are secondary
         if you don't specify any roles, you will be queued as fill
         roles: top, jg, mid, bot, sup''')
 async def queue(ctx, 
                 *args):
-    if args:
-        for role in args:
-            if role not in ['top', 'jg', 'mid', 'bot', 'sup']:
-                raise Exception
-    mmr.insert_user_if_new(ctx.author.name)
-    msg = ''
-    global queued_users
-    global queue_num
-    if ctx.author.name in [user.name for game in games for user in game.blue_team + game.red_team]:
+    try:
+        roles = mmr.preference(args)
+    except ValueError:
+        raise commands.BadArgument(args)
+    state = guilds.state(ctx.guild)
+    lobby = state.lobby(ctx.channel)
+    await state.ratings.get_cache()
+    if (old_name := state.ratings.names.get(ctx.author.id)) and old_name != ctx.author.name:
+        await rename_player(state, old_name, ctx.author.name)
+    await state.ratings.insert_user_if_new(ctx.author.name, ctx.author.id)
+    if state.rank_index is not None and ctx.author.name not in state.rank_index:
+        bot.dispatch('ranks_changed', ctx.guild, state.rank_index.update({ctx.author.name: await state.ratings.get_mmr(ctx.author.name)}))
+        state.leaderboard.invalidate()
+    if state.game_of(ctx.author)[1]:
         await ctx.send('you are already in game')
+    elif state.held_game(ctx.author):
+        await ctx.send('your game is waiting for everyone to accept it')
     else:
-        if ctx.author.name not in [user[0].name for user in queued_users]:
-            queued_users.append((ctx.author, list(args)))
-            queue_num += 1
-            msg += f"{get_display_name(ctx.author)} ({', '.join(args) if args else 'fill'}) has joined the queue\n"
-            user_strs = [get_display_name(user[0]) + f" ({', '.join(user[1]) if user[1] else 'fill'})" for user in queued_users]
-            msg += f"{queue_num:2d}/10 currently in queue: {', '.join(user_strs)}"
-            await ctx.send(discord.utils.escape_markdown(msg))
-            if queue_num >= 10:
-                teams = None
-                match matchmaking_mode:
-                    case mmr.MatchmakingType.balanced:
-                        teams = mmr.Matchmaking(queued_users).matchmake(mmr.Matchmaking.balanced)
-                    case mmr.MatchmakingType.random:
-                        teams = mmr.Matchmaking(queued_users).matchmake(mmr.Matchmaking.random)
-                if teams:
-                    game = mmr.Game(teams[0][0], teams[1][0], teams[0][1], teams[1][1])
-                    games.append(game)
-
-                    queued_users = [user for user in queued_users if user[0] not in game.blue_team + game.red_team]
-                    queue_num -= 10
-                    await ctx.send(game)
-                else:
-                    await ctx.send('can\'t matchmake with current roles')
+        # joins and leaves get a reaction, and the channel's queue message catches up with all of them at once
+        if not lobby.queued(ctx.author):
+            if (other := state.lobby_of.get(ctx.author.name)) not in (None, lobby):
+                # a player queues in one channel at a time, joining another moves them
+                other.leave(ctx.author)
+                await state.save(other)
+                if channel := bot.get_channel(other.channel_id):
+                    queue_status(state, other, channel).touch()
+            lobby.join(ctx.author, roles)
+            lobby.channel_id = ctx.channel.id
+            new_games, reason = pop(state, lobby)
+            await state.save(lobby)
+            await acknowledge(ctx, '\N{WHITE HEAVY CHECK MARK}')
+            queue_status(state, lobby, ctx.channel).touch(reason)
+            start_ready_checks(state, lobby, ctx.channel, new_games)
         else:
-            queued_users = [user for user in queued_users if user[0] != ctx.author]
-            queue_num -= 1
-            msg += f'{get_display_name(ctx.author)} has left the queue\n'
-            user_strs = [get_display_name(user[0]) + f" ({', '.join(user[1]) if user[1] else 'fill'})" for user in queued_users]
-            msg += f"{queue_num:2d}/10 currently in queue: {', '.join(user_strs)}"
-            await ctx.send(discord.utils.escape_markdown(msg))
+            lobby.leave(ctx.author)
+            await state.save(lobby)
+            await acknowledge(ctx, '\N{WAVING HAND SIGN}')
+            queue_status(state, lobby, ctx.channel).touch()
 
 @bot.command(
         help='''displays/changes mode
@@ -99,35 +218,39 @@ async def queue(ctx,
         if argument is given, switch to that mode''')
 async def mode(ctx, 
                mode: typing.Optional[str]=commands.parameter(description=f'mode to switch to\ncan be one of {list(mmr.MatchmakingType.__members__)}')):
-    global matchmaking_mode
+    state = guilds.state(ctx.guild)
+    lobby = state.lobby(ctx.channel)
     if mode:
         try:
-            matchmaking_mode = mmr.MatchmakingType[mode]
+            lobby.mode = mmr.MatchmakingType[mode]
         except KeyError:
             await ctx.send(f'use a valid mode: {list(mmr.MatchmakingType.__members__)}')
+            return
+        await state.save(lobby)
+        queue_status(state, lobby, ctx.channel).touch()
     else:
-        await ctx.send(f'available modes: {list(mmr.MatchmakingType.__members__)}\ncurrent mode: {matchmaking_mode.name}')
+        await ctx.send(f'available modes: {list(mmr.MatchmakingType.__members__)}\ncurrent mode: {lobby.mode.name}')
 
 @bot.command(
         help='''removes all users from the queue''')
 async def clear(ctx):
-    global queue_num
-    queue_num = 0
-    queued_users.clear()
+    state = guilds.state(ctx.guild)
+    lobby = state.lobby(ctx.channel)
+    lobby.clear()
+    await state.save(lobby)
+    queue_status(state, lobby, ctx.channel).touch()
     await ctx.send('queue has been cleared')
 
 @bot.command(
-        help='''voids current game and removes all users from the queue
+        help='''voids current game, the queue is left alone
         can only be used by someone currently in the game''')
 async def reset(ctx):
-    global queue_num
-    for game in games:
-        if ctx.author in game.blue_team + game.red_team:
-            games.remove(game)
-            break
-    queue_num = 0
-    queued_users.clear()
-    await ctx.send('queue has been reset')
+    state = guilds.state(ctx.guild)
+    lobby, game = state.game_of(ctx.author)
+    if game:
+        lobby.end_game(game)
+        await state.save(lobby)
+        await ctx.send('game has been voided')
 
 @bot.command(
         help='''generates two random lists of champions''')
@@ -140,28 +263,31 @@ async def aram(ctx,
         await ctx.send(f'Blue Team: {team1}\nRed Team: {team2}')
 
 async def give_win(ctx, blue_win):
-    user = ctx.author
-    for game in games:
-        if user in game.blue_team + game.red_team:
-            msg = ''
-            mmrs = mmr.get_mmrs()
-            old_ranks = ranks.map_ranks(mmrs)
-            game.update(blue_win)
-            games.remove(game)
-            mmrs = mmr.get_mmrs()
-            bot.dispatch('ranks_changed', [user.name for user in game.blue_team + game.red_team])
-            new_ranks = ranks.map_ranks(mmrs)
-            for name, rank in new_ranks.items():
-                if rank < old_ranks[name]:
-                    user = next(user for user in game.blue_team + game.red_team if user.name == name)
-                    msg += f'{get_display_name(user)} has been demoted from {old_ranks[name].name} to {rank.name}\n'
-                if old_ranks[name] < rank:
-                    user = next(user for user in game.blue_team + game.red_team if user.name == name)
-                    msg += f'{get_display_name(user)} has been promoted from {old_ranks[name].name} to {rank.name}\n'
-            if not msg:
-                msg = 'no ranks have changed'
-            await ctx.send(discord.utils.escape_markdown(msg))
-            break
+    state = guilds.state(ctx.guild)
+    lobby, game = state.game_of(ctx.author)
+    if game:
+        msg = ''
+        lobby.end_game(game)
+        await state.save(lobby)
+        deltas = await game.update(blue_win)
+        changes = {}
+        # ranks are only there once the guild is set up, until then the ratings are saved and nobody's rank changes
+        if state.rank_index is not None:
+            changes = state.rank_index.apply(deltas)
+            state.leaderboard.invalidate()
+            bot.dispatch('ranks_changed', ctx.guild, changes)
+        players = {user.name: user for user in game.blue_team + game.red_team}
+        for name, (old_rank, rank) in changes.items():
+            if not (user := players.get(name) or state.member(name)):
+                continue
+            if rank < old_rank:
+                msg += f'{get_display_name(user)} has been demoted from {old_rank.name} to {rank.name}\n'
+            if old_rank < rank:
+                msg += f'{get_display_name(user)} has been promoted from {old_rank.name} to {rank.name}\n'
+        if not msg:
+            msg = 'no ranks have changed'
+        msg = f'game #{game.id} recorded\n' + msg
+        await ctx.send(discord.utils.escape_markdown(msg))
 
 @bot.command(
         help='''notifies the bot that the blue team has won the current game
@@ -176,36 +302,66 @@ async def red(ctx):
     await give_win(ctx, 0)
 
 @bot.command(name='mmr',
-             help='''gets list of all users sorted by mmr
+             help='''gets a page of the list of all users sorted by mmr
              if name is provided, gets the user's mmr''')
-async def _mmr(ctx, name: typing.Optional[discord.Member]=commands.parameter(description='name of user whose mmr should be returned')):
-    if name:
-        await ctx.send(f'{mmr.get_mmr(name.name):.0f}')
-    else:
-        res = mmr.get_mmrs()
-        res.sort(key=lambda x: x[1], reverse=True)
-        msg = ''
-        for i, (username, rating) in enumerate(res):
-            if guild := bot.get_guild(GUILD_ID):
-                if member := guild.get_member_named(username):
-                    msg += f'{i + 1:2d}: {get_display_name(member)} ({rating:.0f})\n'
-                else:
-                    msg += f'{i + 1:2d}: {username} ({rating:.0f})\n'
-            else:
-                msg += f'{i + 1:2d}: {username} ({rating:.0f})\n'
-        await ctx.send(discord.utils.escape_markdown(msg))
+async def _mmr(ctx, name: typing.Optional[typing.Union[int, discord.Member]]=commands.parameter(description='name of user whose mmr should be returned, or page of the list to show')):
+    state = guilds.state(ctx.guild)
+    if isinstance(name, discord.Member):
+        await ctx.send(f'{await state.ratings.get_mmr(state.player_name(name)):.0f}')
+    elif state.leaderboard:
+        await ctx.send(embed=state.leaderboard.page(name or 1))
 
 @bot.command(
         help='''returns your record
         if name is provided, gets the user's record''')
 async def record(ctx, name: typing.Optional[discord.Member]=commands.parameter(description='name of user whose record should be returned')):
     record = None
+    state = guilds.state(ctx.guild)
+    await state.ratings.get_cache()
     if name:
-        record = mmr.get_stats(name.name)
+        record = await state.ratings.get_stats(state.player_name(name))
     else:
-        record = mmr.get_stats(ctx.author.name)
+        record = await state.ratings.get_stats(state.player_name(ctx.author))
     await ctx.send(f'{record[0]}W - {record[1]}L')
 
+@bot.command(
+        help='''shows your last games and streaks
+        if name is provided, shows the user's games''')
+async def history(ctx,
+                  name: typing.Optional[discord.Member]=commands.parameter(description='name of user whose games should be shown'),
+                  count: int=commands.parameter(default=10, description='number of games to show, at most 25')):
+    state = guilds.state(ctx.guild)
+    player = state.player_name(name or ctx.author)
+    games = await state.ratings.get_history(player, max(1, min(count, 25)))
+    if not games:
+        await ctx.send(f'{get_display_name(name or ctx.author)} has not played a game')
+        return
+    lines = [f'#{game_id:<6}{time.strftime("%Y-%m-%d", time.localtime(played))}  {"W" if won else "L"} {role or "":<4}{mmr:>6.0f} {change:+.0f}'
+             for game_id, played, won, role, mmr, change in games]
+    if streak := await state.ratings.get_streak(player):
+        current, best_win, best_loss = streak
+        lines.append(f'streak {abs(current)}{"W" if current > 0 else "L"}, best {best_win}W, worst {best_loss}L')
+    await ctx.send('```\n' + '\n'.join(lines) + '\n```')
+
+@bot.command(
+        help='''shows how you do with and against another player
+        without the other player, shows your best teammates''')
+async def duo(ctx,
+              name: typing.Optional[discord.Member]=commands.parameter(description='the other player'),
+              other: typing.Optional[discord.Member]=commands.parameter(description='a player to use instead of you')):
+    state = guilds.state(ctx.guild)
+    player = state.player_name(other or ctx.author)
+    if name:
+        (games, wins), (against, against_wins) = await state.ratings.get_duo(player, state.player_name(name))
+        await ctx.send(f'with {get_display_name(name)}: {wins}W - {games - wins}L, '
+                       f'against: {against_wins}W - {against - against_wins}L')
+        return
+    partners = await state.ratings.get_duos(player, DUO_MIN_GAMES, 10)
+    if not partners:
+        await ctx.send(f'no teammate with {DUO_MIN_GAMES} games yet')
+        return
+    await ctx.send('```\n' + '\n'.join(f'{partner:<24}{wins}W - {games - wins}L {wins / games:.0%}' for partner, games, wins in partners) + '\n```')
+
 @bot.command()
 async def shrago(ctx):
     with open('shrago.png', 'rb') as pic:
@@ -218,11 +374,60 @@ async def edboy(ctx):
         file = discord.File(pic)
         await ctx.send(file=file)
 
+@bot.command(
+        help='''recomputes every rating from the game history
+        if a period is given, games in the same period of that many hours are rated together
+        can only be used by admins''')
+@commands.has_permissions(administrator=True)
+async def replay(ctx,
+                 period: typing.Optional[float]=commands.parameter(default=None, description='length of a rating period in hours')):
+    state = guilds.state(ctx.guild)
+    await state.ratings.replay(period * 3600 if period else None)
+    load_ranks(state)
+    synced = state.role_sync.sync(state.rank_index.map()) if state.role_sync else 0
+    await ctx.send(f'ratings recomputed from the game history, {synced} rank roles to update')
+
+@bot.command(
+        help='''changes the result of a recorded game and recomputes every rating
+        result can be blue, red or void
+        can only be used by admins''')
+@commands.has_permissions(administrator=True)
+async def fix(ctx,
+              game_id: int=commands.parameter(description='number of the game to fix'),
+              result: str=commands.parameter(description='blue, red or void')):
+    if result not in ['blue', 'red', 'void']:
+        raise commands.BadArgument(result)
+    state = guilds.state(ctx.guild)
+    if not await state.ratings.fix_game(game_id, {'blue': 1, 'red': 0, 'void': None}[result]):
+        await ctx.send(f'there is no game #{game_id}')
+        return
+    await replay(ctx, None)
+
+@bot.command(
+        help='''shows command, matchmaking and database latencies, event loop lag and discord api calls
+        can only be used by admins''')
+@commands.has_permissions(administrator=True)
+async def stats(ctx):
+    lines = metrics.summary() or ['nothing measured yet']
+    # split into messages under discord's length limit
+    chunk = []
+    for line in lines:
+        if sum(len(part) + 1 for part in chunk) + len(line) > 1900:
+            await ctx.send('```\n' + '\n'.join(chunk) + '\n```')
+            chunk = []
+        chunk.append(line)
+    await ctx.send('```\n' + '\n'.join(chunk) + '\n```')
+
 @bot.command(name='ranks', help='''displays all ranks''')
 async def _ranks(ctx):
     msg = ''
+    state = guilds.state(ctx.guild)
+    # before the guild is set up there is no index yet, only the setting it will be made with
+    percentiles = state.rank_index.percentiles if state.rank_index is not None else ranks.percentiles()
     for rank in sorted(ranks.ALL_RANKS, reverse=True):
         match rank.ordering:
+            case ranks.Rank.Ordering.ABSOLUTE if percentiles:
+                msg += f'{rank.name} (top {100 - rank.percentile}%)\n' if rank.percentile else f'{rank.name} (everyone else)\n'
             case ranks.Rank.Ordering.ABSOLUTE:
                 if rank == ranks.DIAMOND:
                     msg += f'{rank.name} ({rank.r[0]}+)\n'
@@ -234,31 +439,84 @@ async def _ranks(ctx):
                 msg = f'{rank.name} (highest mmr)\n' + msg
     await ctx.send(msg)
 
+def load_ranks(state):
+    state.rank_index = ranks.RankIndex([(name, entry[0]) for name, entry in state.ratings.cache.items()], ranks.percentiles())
+    state.leaderboard = Leaderboard(state.rank_index, state.member)
+
+async def setup_guild(guild):
+    state = guilds.state(guild)
+    if state.role_sync:
+        # on_ready again after a reconnect, everything is still loaded and only the members need fetching again
+        state.members = MemberIndex(guild)
+        return
+    await state.ratings.load_cache()
+    state.members = MemberIndex(guild)
+    await state.restore()
+    load_ranks(state)
+    calls, saved = await ranks.startup(guild)
+    state.role_sync = rolesync.RoleSync(guild, state.member)
+    name_to_rank = state.rank_index.map()
+    queued = state.role_sync.sync(name_to_rank)
+    # every ranked member used to have their role set again on startup, now only the ones that are wrong are
+    saved += sum(1 for name in name_to_rank if state.member(name)) - queued
+    logging.getLogger('discord.ext.bot').info('%s: rank roles reconciled with %d api calls and %d members to update, %d calls saved',
+                                              guild, calls, queued, saved)
+    metrics.count('discord_api_calls_total', calls, call='rank_roles')
+    metrics.count('discord_api_calls_saved_total', saved)
+
 @bot.event
 async def on_ready():
-    if guild := bot.get_guild(GUILD_ID):
-        await ranks.startup(guild)
-        mmrs = mmr.get_mmrs()
-        for name, rank in ranks.map_ranks(mmrs).items():
-            if member := guild.get_member_named(name):
-                if role := discord.utils.get(guild.roles, name=rank.name):
-                    await member.add_roles(role)
-                    time.sleep(.05)
+    await metrics.start(int(port) if (port := os.getenv('METRICS_PORT')) else None)
+    global scheduler
+    if scheduler is None:
+        # built off the event loop before the first queue pop would stall it
+        await asyncio.to_thread(mmr.feasible_table)
+        scheduler = asyncio.create_task(schedule())
+    await asyncio.gather(*[setup_guild(guild) for guild in bot.guilds])
+
+@bot.event
+async def on_guild_join(guild):
+    await setup_guild(guild)
+
+@bot.event
+async def on_member_join(member):
+    if members := guilds.state(member.guild).members:
+        members.add(member)
+
+@bot.event
+async def on_member_remove(member):
+    if members := guilds.state(member.guild).members:
+        members.remove(member)
+
+@bot.event
+async def on_member_update(before, after):
+    if members := guilds.state(after.guild).members:
+        members.update(before, after)
+
+@bot.event
+async def on_user_update(before, after):
+    if before.name == after.name:
+        return
+    for guild in after.mutual_guilds:
+        state = guilds.state(guild)
+        if state.members and (member := guild.get_member(after.id)):
+            state.members.update(before, member)
+        await rename_player(state, before.name, after.name)
+
+async def rename_player(state, old_name, name):
+    if not await state.ratings.rename(old_name, name):
+        return
+    if state.rank_index:
+        state.rank_index.rename(old_name, name)
+        state.leaderboard.invalidate()
+    # queues, ready checks and games are keyed by name too
+    if lobby := state.rename(old_name, name):
+        await state.save(lobby)
 
 @bot.event
-async def on_ranks_changed(names):
-    if guild := bot.get_guild(GUILD_ID):
-        managed_roles = [role for role in guild.roles if role.name in [rank.name for rank in ranks.ALL_RANKS]]
-        for name in names:
-            if member:= guild.get_member_named(name):
-                await member.remove_roles(*managed_roles)
-                time.sleep(.05)
-        mmrs = mmr.get_mmrs()
-        for name, rank in ranks.map_ranks(mmrs).items():
-            if member := guild.get_member_named(name):
-                if role := discord.utils.get(guild.roles, name=rank.name):
-                    await member.add_roles(role)
-                    time.sleep(.05)
+async def on_ranks_changed(guild, changes):
+    if role_sync := guilds.state(guild).role_sync:
+        role_sync.sync({name: rank for name, (_, rank) in changes.items()})
 
 if key := os.getenv('API_KEY'):
     bot.run(key)
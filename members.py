@@ -0,0 +1,24 @@
+import discord
+
+class MemberIndex:
+    # database names (usernames) to members, kept current by the member events instead of scanning the guild
+    def __init__(self, guild: discord.Guild) -> None:
+        self.guild = guild
+        self.by_name = {member.name: member for member in guild.members}
+
+    def add(self, member):
+        self.by_name[member.name] = member
+
+    def remove(self, member):
+        if (current := self.by_name.get(member.name)) and current.id == member.id:
+            del self.by_name[member.name]
+
+    def update(self, before, after):
+        if before.name != after.name:
+            self.remove(before)
+        self.add(after)
+
+    def get(self, name, id=None):
+        if id is not None and (member := self.guild.get_member(id)):
+            return member
+        return self.by_name.get(name)
@@ -0,0 +1,135 @@
+import asyncio
+import bisect
+import collections
+import contextlib
+import logging
+import time
+from aiohttp import web
+
+_log = logging.getLogger(__name__)
+
+# upper bounds in seconds, everything slower lands in +Inf
+BUCKETS = [.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10]
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # the upper bound of the bucket the quantile falls in, inf if it's past the last one
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + [float('inf')], self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+# metrics are keyed by (name, sorted label pairs) so the same name can be split by command, mode, call...
+histograms = collections.defaultdict(Histogram)
+counters = collections.defaultdict(int)
+gauges = {}
+
+def key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def observe(name, value, **labels):
+    histograms[key(name, labels)].observe(value)
+
+def count(name, n=1, **labels):
+    counters[key(name, labels)] += n
+
+def gauge(name, value, **labels):
+    gauges[key(name, labels)] = value
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+async def sample_loop_lag(interval=.5):
+    # how late a sleep wakes up is how long something held the event loop
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - start - interval, 0)
+        observe('event_loop_lag_seconds', lag)
+        gauge('event_loop_lag_seconds_last', lag)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels, **extra):
+    labels = labels + tuple(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+def render():
+    # the prometheus text exposition format
+    lines = []
+    def by_name(metrics):
+        grouped = collections.defaultdict(list)
+        for (name, labels), value in sorted(metrics.items()):
+            grouped[name].append((labels, value))
+        return grouped.items()
+    for name, series in by_name(histograms):
+        lines.append(f'# TYPE {name} histogram')
+        for labels, histogram in series:
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ['+Inf'], histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+            lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+    for name, series in by_name(counters):
+        lines.append(f'# TYPE {name} counter')
+        lines += [f'{name}{format_labels(labels)} {value}' for labels, value in series]
+    for name, series in by_name(gauges):
+        lines.append(f'# TYPE {name} gauge')
+        lines += [f'{name}{format_labels(labels)} {value}' for labels, value in series]
+    return '\n'.join(lines) + '\n'
+
+def summary():
+    # one line per series for !stats, latencies as bucket bounds in ms
+    def ms(seconds):
+        return f'{seconds * 1000:.0f}' if seconds != float('inf') else 'inf'
+    lines = []
+    for (name, labels), histogram in sorted(histograms.items()):
+        label = ','.join(str(value) for _, value in labels)
+        lines.append(f'{name}{f"[{label}]" if label else ""}: n={histogram.count} avg={ms(histogram.sum / histogram.count)}ms '
+                     f'p50<={ms(histogram.quantile(.5))}ms p99<={ms(histogram.quantile(.99))}ms')
+    for (name, labels), total in sorted(counters.items()):
+        label = ','.join(str(value) for _, value in labels)
+        lines.append(f'{name}{f"[{label}]" if label else ""}: {total}')
+    return lines
+
+async def handle(_):
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+lag_sampler = None
+
+async def start(port=None, host='127.0.0.1'):
+    # starts the lag sampler and, given a port, the /metrics endpoint, only the first time it's called
+    global lag_sampler
+    if lag_sampler:
+        return
+    lag_sampler = asyncio.create_task(sample_loop_lag())
+    if port:
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        _log.info('serving metrics on http://%s:%d/metrics', host, port)
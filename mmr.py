@@ -1,145 +1,687 @@
-import sqlite3
+import asyncio
+import collections
+import json
+import time
 import itertools
+import functools
 import random
-from enum import IntEnum, auto
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from enum import IntEnum, IntFlag, auto
 from utils import get_display_name
+from database import Database
+import metrics
+import rating
 
-db = sqlite3.connect('bot.db')
+MIGRATIONS = [
+    '''
+    CREATE TABLE IF NOT EXISTS mmr (name TEXT, mmr REAL DEFAULT 1200, W INTEGER DEFAULT 0, L INTEGER DEFAULT 0);
+    CREATE TABLE mmr_new (name TEXT PRIMARY KEY, mmr REAL NOT NULL DEFAULT 1200, W INTEGER NOT NULL DEFAULT 0, L INTEGER NOT NULL DEFAULT 0);
+    INSERT INTO mmr_new (name, mmr, W, L)
+        SELECT name, mmr, IFNULL(W, 0), IFNULL(L, 0) FROM mmr WHERE rowid IN (SELECT MIN(rowid) FROM mmr GROUP BY name);
+    DROP TABLE mmr;
+    ALTER TABLE mmr_new RENAME TO mmr;
+    CREATE TABLE games (
+        id INTEGER PRIMARY KEY,
+        time REAL NOT NULL,
+        blue TEXT NOT NULL,
+        red TEXT NOT NULL,
+        expected REAL NOT NULL,
+        change REAL NOT NULL,
+        blue_win INTEGER NOT NULL
+    );
+    ''',
+    '''
+    ALTER TABLE mmr ADD COLUMN id INTEGER;
+    CREATE UNIQUE INDEX mmr_id ON mmr (id);
+    ''',
+    '''
+    ALTER TABLE mmr ADD COLUMN rd REAL;
+    ALTER TABLE mmr ADD COLUMN vol REAL;
+    ''',
+    '''
+    CREATE TABLE fixes (
+        id INTEGER PRIMARY KEY,
+        game_id INTEGER NOT NULL REFERENCES games (id),
+        time REAL NOT NULL,
+        blue_win INTEGER
+    );
+    CREATE INDEX fixes_game ON fixes (game_id);
+    ''',
+    '''
+    CREATE TABLE lobbies (lobby INTEGER PRIMARY KEY, state TEXT NOT NULL);
+    ''',
+    '''
+    CREATE TABLE game_players (
+        game_id INTEGER NOT NULL REFERENCES games (id),
+        name TEXT NOT NULL,
+        time REAL NOT NULL,
+        blue INTEGER NOT NULL,
+        role TEXT,
+        won INTEGER NOT NULL,
+        mmr REAL NOT NULL,
+        change REAL NOT NULL,
+        PRIMARY KEY (game_id, name)
+    );
+    CREATE INDEX game_players_name ON game_players (name, time);
+    CREATE TABLE duos (
+        name TEXT NOT NULL,
+        partner TEXT NOT NULL,
+        same_team INTEGER NOT NULL,
+        games INTEGER NOT NULL,
+        wins INTEGER NOT NULL,
+        PRIMARY KEY (name, partner, same_team)
+    ) WITHOUT ROWID;
+    CREATE TABLE streaks (name TEXT PRIMARY KEY, current INTEGER NOT NULL, best_win INTEGER NOT NULL, best_loss INTEGER NOT NULL);
+    ''',
+    # the history is backfilled two migrations on, once the ratings from before the log are kept to replay it from
+    lambda conn: None,
+    # what everyone had before the game log was kept: their rating now less what the logged games changed it by, which is
+    # exact under elo where everyone gets their team's change. replays start from these instead of from nothing
+    '''
+    CREATE TABLE seeds (name TEXT PRIMARY KEY, mmr REAL NOT NULL, W INTEGER NOT NULL, L INTEGER NOT NULL);
+    INSERT INTO seeds (name, mmr, W, L)
+        SELECT mmr.name, mmr.mmr - IFNULL(log.change, 0), mmr.W - IFNULL(log.W, 0), mmr.L - IFNULL(log.L, 0)
+        FROM mmr LEFT JOIN (
+            SELECT player.value AS name, SUM(IIF(side.blue, games.change, -games.change)) AS change,
+                   SUM(side.blue = games.blue_win) AS W, SUM(side.blue != games.blue_win) AS L
+            FROM games, (SELECT 1 AS blue UNION ALL SELECT 0) AS side, json_each(IIF(side.blue, games.blue, games.red)) AS player
+            GROUP BY player.value) AS log ON log.name = mmr.name;
+    ''',
+    lambda conn: rebuild_history(conn, rating.engine()),
+]
+
+Player = collections.namedtuple('Player', ['name', 'nick'], defaults=[None])
+
+def read_games(conn):
+    # the game log in order as (id, time, blue, red, blue win), with the latest fix to each game applied, a fix with no winner
+    # voids the game
+    rows = conn.execute('''
+        SELECT games.id, games.time, games.blue, games.red, IIF(fixes.id IS NULL, games.blue_win, fixes.blue_win)
+        FROM games LEFT JOIN fixes ON fixes.id = (SELECT MAX(id) FROM fixes WHERE game_id = games.id)
+        WHERE fixes.id IS NULL OR fixes.blue_win IS NOT NULL
+        ORDER BY games.id''')
+    for id, time, blue, red, blue_win in rows:
+        yield id, time, json.loads(blue), json.loads(red), blue_win
+
+def read_seeds(conn):
+    return {name: (mmr, w, l) for name, mmr, w, l in conn.execute('SELECT name, mmr, W, L FROM seeds')}
+
+def replay_log(conn, engine, period=None):
+    # the game log and (ratings, history) from replaying it on top of the seeds
+    games = list(read_games(conn))
+    history = {}
+    results = rating.replay(engine, [game[1:] for game in games], period, history, read_seeds(conn))
+    return games, results, history
+
+def write_ratings(conn, engine, results):
+    # everyone starts over and then gets what the replay gave them, all in one statement
+    conn.execute('UPDATE mmr SET mmr = ?, W = 0, L = 0, rd = ?, vol = ?', (engine.start, engine.start_rd, engine.start_vol))
+    conn.executemany('''INSERT INTO mmr (name, mmr, W, L, rd, vol) VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (name) DO UPDATE SET mmr = excluded.mmr, W = excluded.W, L = excluded.L, rd = excluded.rd, vol = excluded.vol''',
+                     [(name, float(mmr), int(w), int(l), float(rd), float(vol)) for name, (mmr, rd, vol, w, l) in results.items()])
+
+def record_game(conn, game_id, time, rows):
+    # rows are (name, blue, role, won, mmr before, change), the game goes in the history and every aggregate in one go
+    conn.executemany('INSERT INTO game_players (game_id, name, time, blue, role, won, mmr, change) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     [(game_id, name, time, blue, role, won, mmr, change) for name, blue, role, won, mmr, change in rows])
+    conn.executemany('''INSERT INTO duos (name, partner, same_team, games, wins) VALUES (?, ?, ?, 1, ?)
+                        ON CONFLICT (name, partner, same_team) DO UPDATE SET games = games + 1, wins = wins + excluded.wins''',
+                     [(name, partner, int(blue == partner_blue), won)
+                      for name, blue, _, won, _, _ in rows for partner, partner_blue, _, _, _, _ in rows if partner != name])
+    # current is the length of the streak, positive for wins and negative for losses
+    conn.executemany('''INSERT INTO streaks (name, current, best_win, best_loss) VALUES (?, ?, ?, ?)
+                        ON CONFLICT (name) DO UPDATE SET
+                            current = IIF(excluded.current > 0, MAX(current, 0) + 1, MIN(current, 0) - 1),
+                            best_win = MAX(best_win, IIF(excluded.current > 0, MAX(current, 0) + 1, 0)),
+                            best_loss = MAX(best_loss, IIF(excluded.current < 0, 1 - MIN(current, 0), 0))''',
+                     [(name, 1 if won else -1, int(won), int(not won)) for name, _, _, won, _, _ in rows])
+
+def tally(keys, weights):
+    # the distinct keys with how often each came up and the sum of its weights, counted straight into a bin per possible key
+    # when there aren't more of those than keys
+    if keys.size and keys.max() < keys.size:
+        counts = np.bincount(keys)
+        present = np.flatnonzero(counts)
+        return present, counts[present], np.bincount(keys, weights)[present]
+    present, inverse = np.unique(keys, return_inverse=True)
+    return present, np.bincount(inverse), np.bincount(inverse, weights)
+
+def write_history(conn, games, history):
+    # rewrites the history and its aggregates from the arrays the replay rated the log with, keeping the roles live games
+    # recorded. duos and streaks are counted here rather than in sql, and every table is emptied and loaded in one go with
+    # the name index built again afterwards instead of kept up row by row
+    names = np.array(history['names'], dtype=object)
+    players = history['players']
+    count, size = players.shape
+    blue = np.arange(size) < size // 2
+    won = blue[None] == history['blue_win'][:, None]
+    roles = {(game_id, name): role for game_id, name, role in conn.execute('SELECT game_id, name, role FROM game_players WHERE role IS NOT NULL')}
+    conn.execute('DELETE FROM game_players')
+    conn.execute('DELETE FROM duos')
+    conn.execute('DELETE FROM streaks')
+    conn.execute('DROP INDEX game_players_name')
+    game_ids = np.repeat([game[0] for game in games], size).tolist()
+    player_names = names[players].ravel().tolist()
+    conn.executemany('INSERT INTO game_players (game_id, name, time, blue, role, won, mmr, change) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     zip(game_ids, player_names, np.repeat([game[1] for game in games], size).tolist(), np.tile(blue, count).astype(int).tolist(),
+                         [roles.get(key) for key in zip(game_ids, player_names)] if roles else itertools.repeat(None),
+                         won.ravel().astype(int).tolist(), history['mmr'].ravel().tolist(), history['change'].ravel().tolist()))
+    conn.execute('CREATE INDEX game_players_name ON game_players (name, time)')
+    # every ordered pair of players in a game, keyed by (player, partner, same team)
+    pairs = ~np.eye(size, dtype=bool)
+    player = np.broadcast_to(players[:, :, None], (count, size, size))[:, pairs]
+    partner = np.broadcast_to(players[:, None, :], (count, size, size))[:, pairs]
+    same_team = np.broadcast_to(blue[:, None] == blue[None, :], (size, size))[pairs]
+    keys, played, wins = tally(((player * len(names) + partner) * 2 + same_team).ravel(),
+                               np.broadcast_to(won[:, :, None], (count, size, size))[:, pairs].ravel())
+    conn.executemany('INSERT INTO duos (name, partner, same_team, games, wins) VALUES (?, ?, ?, ?, ?)',
+                     zip(names[keys // 2 // len(names)].tolist(), names[keys // 2 % len(names)].tolist(), (keys % 2).tolist(),
+                         played.tolist(), wins.astype(int).tolist()))
+    # each player's results in order, split into runs of the same result
+    order = np.argsort(players.ravel(), kind='stable')
+    player, result = players.ravel()[order], won.ravel()[order]
+    starts = np.flatnonzero(np.concatenate([[True], (player[1:] != player[:-1]) | (result[1:] != result[:-1])])) if player.size else np.zeros(0, dtype=int)
+    lengths = np.diff(np.append(starts, player.size))
+    player, result = player[starts], result[starts]
+    best = np.zeros((2, len(names)), dtype=int)
+    np.maximum.at(best, (result.astype(int), player), lengths)
+    last = np.flatnonzero(np.append(player[1:] != player[:-1], True)) if player.size else starts
+    conn.executemany('INSERT INTO streaks (name, current, best_win, best_loss) VALUES (?, ?, ?, ?)',
+                     zip(names[player[last]].tolist(), np.where(result[last], lengths[last], -lengths[last]).tolist(),
+                         best[1][player[last]].tolist(), best[0][player[last]].tolist()))
+
+def rebuild_history(conn, engine, period=None):
+    games, _, history = replay_log(conn, engine, period)
+    write_history(conn, games, history)
+
+class Role(IntFlag):
+    top = auto()
+    jg = auto()
+    mid = auto()
+    bot = auto()
+    sup = auto()
+    fill = top | jg | mid | bot | sup
+
+ROLES = ['top', 'jg', 'mid', 'bot', 'sup']
+FILL = int(Role.fill)
+# how much worse in average mmr a game may be to put one more player on their primary role
+OFF_ROLE_PENALTY = 15
+
+# the first role a player queues for is their primary, the rest are secondary, fill has every role as primary
+Preference = collections.namedtuple('Preference', ['primary', 'roles'])
+FILL_PREFERENCE = Preference(FILL, FILL)
+
+def preference(roles):
+    if any(role not in ROLES for role in roles):
+        raise ValueError(roles)
+    if not roles:
+        return FILL_PREFERENCE
+    return Preference(role_mask(roles[:1]), role_mask(roles))
+
+def describe(preference):
+    if preference.roles == FILL:
+        return 'fill'
+    secondary = [role.name for role in Role(preference.roles & ~preference.primary)]
+    return ' > '.join([Role(preference.primary).name] + ([', '.join(secondary)] if secondary else []))
+GAME_SIZE = 10
+BATCH_QUEUE_SIZE = 20
+
+# how far apart in average mmr the teams of a game may be, widening the longer its longest waiting player has waited
+BASE_GAP = 25
+GAP_PER_MINUTE = 25
+
+def allowed_gap(wait):
+    return BASE_GAP + GAP_PER_MINUTE * wait / 60
 
 class MatchmakingType(IntEnum):
     balanced = auto()
     random = auto()
+    batch = auto()
+
+# every split of a lobby into two teams with player 0 on the first team, and the other team for each
+SPLIT_INDEX = np.array([(0,) + team for team in itertools.combinations(range(1, GAME_SIZE), GAME_SIZE // 2 - 1)])
+OTHER_INDEX = np.array([[i for i in range(GAME_SIZE) if i not in team] for team in SPLIT_INDEX])
+# the most players batch matchmaking leaves out of a run of players next to each other by mmr to make a lobby of the rest,
+# and for each count, every way to do it that keeps the run's first and last player so no lobby is made twice
+LEAVE_OUT = 2
+LOBBY_INDEX = [np.array([(0,) + kept + (GAME_SIZE + k - 1,) for kept in itertools.combinations(range(1, GAME_SIZE + k - 1), GAME_SIZE - 2)])
+               for k in range(LEAVE_OUT + 1)]
+POPCOUNT = np.array([bin(mask).count('1') for mask in range(FILL + 1)])
+# CONFINED[mask, roles] is whether a player with that mask can only play some of those roles, and by hall's theorem a team can be
+# assigned roles exactly when no set of roles has more players confined to it than it has roles
+CONFINED = np.array([[mask & ~roles == 0 for roles in range(FILL + 1)] for mask in range(FILL + 1)], dtype=np.int8)
+# a team's masks sorted and packed 5 bits each are the key into a bit table of every multiset of masks that can be assigned
+KEY_SHIFTS = np.arange(0, 5 * len(ROLES), 5)
+
+@functools.cache
+def feasible_table():
+    # built on first use, about half a second for every one of the 324k multisets
+    teams = np.array(list(itertools.combinations_with_replacement(range(1, FILL + 1), len(ROLES))))
+    feasible = (CONFINED[teams].sum(axis=-2) <= POPCOUNT).all(axis=-1)
+    table = np.zeros(1 << 5 * len(ROLES), dtype=bool)
+    table[(teams << KEY_SHIFTS).sum(axis=-1)] = feasible
+    return np.packbits(table, bitorder='little')
 
-def expected(elo1, elo2):
-    return 1 / (1 + 10 ** ((elo2 - elo1) / 400))
+def role_mask(roles):
+    mask = 0
+    for role in roles:
+        mask |= 1 << ROLES.index(role)
+    return mask or FILL
 
-def mmr_change(expected, actual, k=100):
-    return k * (actual - expected)
+@functools.lru_cache(maxsize=4096)
+def assign_roles(masks, primaries=None):
+    # matches players to roles over bitmasks putting as many as possible on their primary role, gives the role index of each
+    # player or None
+    primaries = primaries or masks
+    @functools.cache
+    def assign(i, used):
+        # (players off their primary role, roles) for players i and on, given the roles already taken
+        if i == len(masks):
+            return 0, ()
+        best = None
+        free = masks[i] & ~used
+        while free:
+            role = free & -free
+            rest = assign(i + 1, used | role)
+            if rest is not None and (best is None or rest[0] + (not role & primaries[i]) < best[0]):
+                best = rest[0] + (not role & primaries[i]), (role.bit_length() - 1,) + rest[1]
+            free ^= role
+        return best
+    best = assign(0, 0)
+    return best and best[1]
+
+def team_roles(team, roles):
+    return assign_roles(tuple(roles[user].roles for user in team), tuple(roles[user].primary for user in team))
+
+def off_role(team, roles, assignment):
+    return sum(not roles[user].primary >> role & 1 for user, role in zip(team, assignment))
 
 class Game:
-    def __init__(self, team1_names, team2_names, team1_mmr, team2_mmr):
+    # a snapshot of the game as it was made: every player's mmr and both outcomes' changes are taken once, and the card is
+    # rendered once and kept until the game changes
+    __slots__ = ['ratings', 'blue_team', 'red_team', 'blue_roles', 'red_roles', 'id', 'blue_mmr', 'red_mmr', 'expected',
+                 'mmrs', 'changes', 'card']
+
+    def __init__(self, ratings, team1_names, team2_names, team1_mmr, team2_mmr, team1_roles=None, team2_roles=None, mmrs=None):
+        self.ratings = ratings
         self.blue_team = team1_names
         self.red_team = team2_names
+        self.blue_roles = team1_roles
+        self.red_roles = team2_roles
+        self.id = None
         self.blue_mmr = team1_mmr / 5
         self.red_mmr = team2_mmr / 5
-        self.expected = expected(team1_mmr / 5, team2_mmr / 5)
-
-    def update(self, actual):
-        change = mmr_change(self.expected, actual)
-        cur = db.cursor()
-        for name in self.blue_team:
-            if change > 0:
-                cur.execute('UPDATE mmr SET W = W + 1 WHERE name = ?', (name.name,))
-            else:
-                cur.execute('UPDATE mmr SET L = L + 1 WHERE name = ?', (name.name,))
-            cur.execute('UPDATE mmr SET mmr = mmr + ? WHERE name = ?', (change, name.name))
-        for name in self.red_team:
-            if -change > 0:
-                cur.execute('UPDATE mmr SET W = W + 1 WHERE name = ?', (name.name,))
-            else:
-                cur.execute('UPDATE mmr SET L = L + 1 WHERE name = ?', (name.name,))
-            cur.execute('UPDATE mmr SET mmr = mmr + ? WHERE name = ?', (-change, name.name))
-        db.commit()
+        self.expected = float(ratings.engine.expected(np.array([self.blue_mmr]), np.array([self.red_mmr])))
+        # the mmrs matchmaking balanced with, so the card shows what the teams were made from
+        self.mmrs = {user.name: mmrs[user.name] if mmrs and user.name in mmrs else ratings.cached_mmr(user.name)
+                     for user in team1_names + team2_names}
+        self.changes = {actual: self.team_changes(actual) for actual in (1, 0)}
+        self.card = None
 
-    def __str__(self) -> str:
-        res = f'```{"":-^50}\n'
+    def rate(self, actual):
+        return self.ratings.rate([user.name for user in self.blue_team], [user.name for user in self.red_team], actual)
+
+    def team_changes(self, actual):
+        changes = self.rate(actual)
+        blue = sum(changes[user.name][0] for user in self.blue_team) / len(self.blue_team)
+        red = sum(changes[user.name][0] for user in self.red_team) / len(self.red_team)
+        return blue, red
+
+    async def update(self, actual):
+        # rated on the current ratings rather than the snapshot, in case a replay changed them while the game was played
+        changes = self.rate(actual)
+        rows = [(*changes[user.name], int(bool(actual)), int(not actual), user.name) for user in self.blue_team]
+        rows += [(*changes[user.name], int(not actual), int(bool(actual)), user.name) for user in self.red_team]
+        change = sum(changes[user.name][0] for user in self.blue_team) / len(self.blue_team)
+        history = [(user.name, int(blue), role, int(blue == bool(actual)), self.ratings.cached_mmr(user.name), changes[user.name][0])
+                   for blue, team, roles in [(True, self.blue_team, self.blue_roles), (False, self.red_team, self.red_roles)]
+                   for user, role in zip(team, roles or [None] * len(team))]
+        now = time.time()
+        def write(conn):
+            cur = conn.cursor()
+            cur.executemany('UPDATE mmr SET mmr = mmr + ?, rd = ?, vol = ?, W = W + ?, L = L + ? WHERE name = ?', rows)
+            cur.execute('INSERT INTO games (time, blue, red, expected, change, blue_win) VALUES (?, ?, ?, ?, ?, ?)',
+                        (now, json.dumps([user.name for user in self.blue_team]), json.dumps([user.name for user in self.red_team]),
+                         self.expected, change, int(actual)))
+            record_game(conn, cur.lastrowid, now, history)
+            return cur.lastrowid
+        self.id = await self.ratings.db.write(write)
+        self.card = None
+        stats = await self.ratings.get_cache()
+        for delta, rd, vol, w, l, name in rows:
+            if entry := stats.get(name):
+                entry[0] += delta
+                entry[1] += w
+                entry[2] += l
+                entry[3] = rd
+                entry[4] = vol
+        return {name: delta for delta, _, _, _, _, name in rows}
+
+    def render(self):
+        res = f'```{f" #{self.id} " if self.id else "":-^50}\n'
         line = f'Blue Team ({self.blue_mmr:.0f})'
         length = 50 - len(line)
         res += line + f'Red Team ({self.red_mmr:.0f})'.rjust(length) + '\n'
-        line = f'{mmr_change(self.expected, 1):+.0f} {mmr_change(self.expected, 0):+.0f}'
-        res += line + f'{mmr_change(1 - self.expected, 1):+.0f} {mmr_change(1 - self.expected, 0):+.0f}'.rjust(50 - len(line)) + '\n'
+        (blue_win, red_loss), (blue_loss, red_win) = self.changes[1], self.changes[0]
+        line = f'{blue_win:+.0f} {blue_loss:+.0f}'
+        res += line + f'{red_win:+.0f} {red_loss:+.0f}'.rjust(50 - len(line)) + '\n'
         line = f'{self.expected:.2%}'
         res += line + f'{1 - self.expected:.2%}'.rjust(50 - len(line))
         res += f'\n{"":-^50}\n'
-        for blue, red in zip(self.blue_team, self.red_team):
-            blue_mmr = get_mmr(blue.name)
-            red_mmr = get_mmr(red.name)
-            line = f'{get_display_name(blue)} ({blue_mmr:.0f})'
+        for i, (blue, red) in enumerate(zip(self.blue_team, self.red_team)):
+            line = f'{get_display_name(blue)} ({self.mmrs[blue.name]:.0f})'
+            red = f'{get_display_name(red)} ({self.mmrs[red.name]:.0f})'
+            if self.blue_roles and self.red_roles:
+                line = f'{self.blue_roles[i]:<4}' + line
+                red += f'{self.red_roles[i]:>4}'
             length = 50 - len(line)
-            red = f'{get_display_name(red)} ({red_mmr:.0f})'
             res += line + red.rjust(length) + '\n'
         res += f'{"":-^50}\n```'
         return res
 
-def get_mmr(name):
-    cur = db.cursor()
-    try:
-        return cur.execute('SELECT mmr FROM mmr WHERE name = ?', (name,)).fetchone()[0]
-    except:
+    def __str__(self) -> str:
+        if self.card is None:
+            self.card = self.render()
+        return self.card
+
+class Ratings:
+    # one guild's rating table, with a name -> [mmr, W, L] cache written through by everything that changes it
+    def __init__(self, path, engine=None) -> None:
+        self.db = Database(path, MIGRATIONS)
+        self.engine = engine or rating.engine()
+        self.cache = None
+        self.cache_lock = asyncio.Lock()
+        # discord user ids of the players that have one stored, both ways
+        self.ids = {}
+        self.names = {}
+
+    async def load_cache(self):
+        def read(conn):
+            return conn.execute('SELECT name, mmr, W, L, rd, vol, id FROM mmr').fetchall()
+        rows = await self.db.read(read)
+        # elo keeps no deviation or volatility and stores 0 for both, so like NULL they mean the engine's starting values, a
+        # switch to glicko-2 would otherwise never move anyone's rating again
+        self.cache = {name: [mmr, w, l, rd if rd and rd > 0 else self.engine.start_rd, vol if vol and vol > 0 else self.engine.start_vol]
+                      for name, mmr, w, l, rd, vol, _ in rows}
+        self.ids = {name: id for name, _, _, _, _, _, id in rows if id is not None}
+        self.names = {id: name for name, id in self.ids.items()}
+        return self.cache
+
+    async def reload(self):
+        # the cache is swapped for a fresh one rather than dropped, so the sync readers never see it missing
+        async with self.cache_lock:
+            return await self.load_cache()
+
+    async def get_cache(self):
+        if self.cache is None:
+            async with self.cache_lock:
+                if self.cache is None:
+                    return await self.load_cache()
+        return self.cache
+
+    def cached_mmr(self, name):
+        if self.cache and (entry := self.cache.get(name)):
+            return entry[0]
         return 0
 
-def get_mmrs():
-    cur = db.cursor()
-    return cur.execute('SELECT name, mmr FROM mmr').fetchall()
+    async def get_mmr(self, name):
+        await self.get_cache()
+        return self.cached_mmr(name)
+
+    async def get_mmrs(self):
+        return [(name, entry[0]) for name, entry in (await self.get_cache()).items()]
+
+    async def get_stats(self, name):
+        if entry := (await self.get_cache()).get(name):
+            return entry[1], entry[2]
+        return None
+
+    async def insert_user_if_new(self, name, id=None):
+        stats = await self.get_cache()
+        if name not in stats:
+            # claim the name right away so a second !queue can't insert it again while this one is being written
+            stats[name] = [self.engine.start, 0, 0, self.engine.start_rd, self.engine.start_vol]
+            self.set_id(name, id)
+            def insert(conn):
+                conn.execute('INSERT INTO mmr (name, mmr, rd, vol, id) VALUES (?, ?, ?, ?, ?)',
+                             (name, self.engine.start, self.engine.start_rd, self.engine.start_vol, id))
+            await self.db.write(insert)
+        elif id is not None and name not in self.ids and id not in self.names:
+            self.set_id(name, id)
+            def backfill(conn):
+                conn.execute('UPDATE mmr SET id = ? WHERE name = ?', (id, name))
+            await self.db.write(backfill)
+
+    def rate(self, blue_names, red_names, blue_win):
+        # name -> (mmr change, new rd, new volatility) for a game the cached players would play
+        names = blue_names + red_names
+        start = [self.engine.start, 0, 0, self.engine.start_rd, self.engine.start_vol]
+        entries = [(self.cache or {}).get(name, start) for name in names]
+        mmr = np.array([entry[0] for entry in entries], dtype=float)
+        rd = np.array([entry[3] for entry in entries], dtype=float)
+        vol = np.array([entry[4] for entry in entries], dtype=float)
+        blue = np.arange(len(blue_names))[None]
+        red = np.arange(len(blue_names), len(names))[None]
+        new_mmr, new_rd, new_vol = self.engine.rate(mmr, rd, vol, blue, red, np.array([float(blue_win)]))
+        return {name: (float(new_mmr[i] - mmr[i]), float(new_rd[i]), float(new_vol[i])) for i, name in enumerate(names)}
+
+    async def replay(self, period=None):
+        # recomputes every rating from the game log in one pass and rewrites the mmr table with the results
+        def write(conn):
+            games, results, history = replay_log(conn, self.engine, period)
+            write_ratings(conn, self.engine, results)
+            write_history(conn, games, history)
+        await self.db.write(write)
+        return await self.reload()
+
+    async def fix_game(self, game_id, blue_win):
+        # the log is never edited, a fix is appended and replaying applies it, blue_win None voids the game
+        def write(conn):
+            if not conn.execute('SELECT 1 FROM games WHERE id = ?', (game_id,)).fetchone():
+                return False
+            conn.execute('INSERT INTO fixes (game_id, time, blue_win) VALUES (?, ?, ?)', (game_id, time.time(), blue_win))
+            return True
+        return await self.db.write(write)
+
+    def set_id(self, name, id):
+        if id is not None:
+            self.ids[name] = id
+            self.names[id] = name
+
+    async def rename(self, old_name, name):
+        # a player that changed their username keeps their row, found by their id
+        stats = await self.get_cache()
+        if name in stats or old_name not in stats:
+            return False
+        stats[name] = stats.pop(old_name)
+        self.set_id(name, self.ids.pop(old_name, None))
+        def write(conn):
+            conn.execute('UPDATE mmr SET name = ? WHERE name = ?', (name, old_name))
+            # the log too, so replays and the history still see one player
+            for team in ['blue', 'red']:
+                conn.execute(f'''UPDATE games SET {team} = (SELECT json_group_array(IIF(value = :old, :new, value)) FROM json_each({team}))
+                                 WHERE EXISTS (SELECT 1 FROM json_each({team}) WHERE value = :old)''', {'old': old_name, 'new': name})
+            conn.execute('UPDATE game_players SET name = ? WHERE name = ?', (name, old_name))
+            conn.execute('UPDATE duos SET name = ? WHERE name = ?', (name, old_name))
+            conn.execute('UPDATE duos SET partner = ? WHERE partner = ?', (name, old_name))
+            conn.execute('UPDATE streaks SET name = ? WHERE name = ?', (name, old_name))
+            conn.execute('UPDATE seeds SET name = ? WHERE name = ?', (name, old_name))
+        await self.db.write(write)
+        return True
+
+    async def get_history(self, name, limit):
+        # newest first, read off the (name, time) index
+        def read(conn):
+            return conn.execute('''SELECT game_id, time, won, role, mmr, change FROM game_players
+                                   WHERE name = ? ORDER BY time DESC LIMIT ?''', (name, limit)).fetchall()
+        return await self.db.read(read)
 
-def get_stats(name):
-    cur = db.cursor()
-    return cur.execute('SELECT W, L FROM mmr WHERE name = ?', (name,)).fetchone()
+    async def get_streak(self, name):
+        def read(conn):
+            return conn.execute('SELECT current, best_win, best_loss FROM streaks WHERE name = ?', (name,)).fetchone()
+        return await self.db.read(read)
 
-def insert_user_if_new(name):
-        cur = db.cursor()
-        if not get_mmr(name):
-            cur.execute('INSERT INTO mmr (name, mmr) VALUES (?, 1200)', (name,))
-            db.commit()
+    async def get_duo(self, name, partner):
+        # (games, wins) of name with partner on the same team and against them
+        def read(conn):
+            return {bool(same_team): (games, wins) for same_team, games, wins in
+                    conn.execute('SELECT same_team, games, wins FROM duos WHERE name = ? AND partner = ?', (name, partner))}
+        stats = await self.db.read(read)
+        return stats.get(True, (0, 0)), stats.get(False, (0, 0))
+
+    async def get_duos(self, name, min_games, limit):
+        # best win rates with a teammate, over the name's rows of the duos key
+        def read(conn):
+            return conn.execute('''SELECT partner, games, wins FROM duos WHERE name = ? AND same_team = 1 AND games >= ?
+                                   ORDER BY CAST(wins AS REAL) / games DESC, games DESC LIMIT ?''', (name, min_games, limit)).fetchall()
+        return await self.db.read(read)
 
 class Matchmaking:
-    def __init__(self, queued_users) -> None:
-        self.mmrs = {user[0].name: get_mmr(user[0].name) for user in queued_users}
+    def __init__(self, ratings, queued_users, waits=None) -> None:
+        self.mmrs = {user[0].name: ratings.cached_mmr(user[0].name) for user in queued_users}
         self.users = [user[0] for user in queued_users]
         self.roles = {user[0]: user[1] for user in queued_users}
+        # name -> seconds waited, given when games should only be made once they are close enough for how long it's been
+        self.waits = waits
 
     def team_mmr(self, team):
         return sum([self.mmrs[user.name] for user in team])
         
     def matchmake(self, fun):
-        potential_teams = [team for team in itertools.combinations(self.users, 5)]
-        blue_team, red_team = fun(potential_teams, self.users, self.mmrs, self.roles)
-        return (list(blue_team), self.team_mmr(blue_team)), (list(red_team), self.team_mmr(red_team))
-        
+        with metrics.timer('matchmaking_seconds', mode=fun.__name__):
+            teams = fun(self.users, self.mmrs, self.roles)
+        if not teams:
+            return None
+        (blue_team, blue_roles), (red_team, red_roles) = teams
+        return (blue_team, self.team_mmr(blue_team), blue_roles), (red_team, self.team_mmr(red_team), red_roles)
+
+    def matchmake_batch(self):
+        games = []
+        waits = None if self.waits is None else [self.waits.get(user.name, 0) for user in self.users]
+        with metrics.timer('matchmaking_seconds', mode='batch'):
+            teams = Matchmaking.batch(self.users, self.mmrs, self.roles, waits)
+        for (blue_team, blue_roles), (red_team, red_roles) in teams:
+            games.append(((blue_team, self.team_mmr(blue_team), blue_roles), (red_team, self.team_mmr(red_team), red_roles)))
+        return games
+
+    def acceptable(self, teams):
+        if self.waits is None:
+            return True
+        (blue_team, blue_mmr, _), (red_team, red_mmr, _) = teams
+        wait = max(self.waits.get(user.name, 0) for user in blue_team + red_team)
+        return abs(blue_mmr - red_mmr) / (GAME_SIZE // 2) <= allowed_gap(wait)
+
     @staticmethod
-    def random(potential_teams, names, _, roles):
-        team1 = random.choice(potential_teams)
-        team2 = [name for name in names if name not in team1]
-        return team1, team2
+    def random(names, _, roles):
+        team1, team2 = random.choice(list(splits(random.sample(names, len(names)))))
+        return order_by_role(team1, roles), order_by_role(team2, roles)
 
     @staticmethod
-    def balanced(potential_teams, names, mmrs, roles):
-        potential_teams = list(potential_teams)
-        random.shuffle(potential_teams)
-        def team_mmr(team):
-            return sum([mmrs[user.name] for user in team])
-        def mmr_difference(team):
-            return abs(team_mmr(team) - team_mmr([user for user in names if user not in team]))
-        potential_teams.sort(key=mmr_difference)
-        for team in potential_teams:
-            team2 = [name for name in names if name not in team]
-            if is_valid_team(team, roles) and is_valid_team(team2, roles):
-                return team, team2
-        return None
+    def balanced(names, mmrs, roles):
+        # the split with the smallest average mmr difference plus a penalty for every player off their primary role
+        names = random.sample(names, len(names))
+        def mmr_difference(teams):
+            return abs(sum([mmrs[user.name] for user in teams[0]]) - sum([mmrs[user.name] for user in teams[1]]))
+        best = None
+        best_cost = np.inf
+        for team1, team2 in sorted(splits(names), key=mmr_difference):
+            cost = mmr_difference((team1, team2)) / (GAME_SIZE // 2)
+            if cost >= best_cost:
+                # the rest are further apart already, penalty or not
+                break
+            blue_roles = team_roles(team1, roles)
+            if blue_roles is None:
+                continue
+            red_roles = team_roles(team2, roles)
+            if red_roles is None:
+                continue
+            cost += OFF_ROLE_PENALTY * (off_role(team1, roles, blue_roles) + off_role(team2, roles, red_roles))
+            if cost < best_cost:
+                best = order_by_role(team1, roles, blue_roles), order_by_role(team2, roles, red_roles)
+                best_cost = cost
+        return best
+
+    @staticmethod
+    def batch(names, mmrs, roles, waits=None):
+        ratings = np.array([mmrs[user.name] for user in names], dtype=float)
+        waits = None if waits is None else np.asarray(waits, dtype=float)
+        masks = np.array([roles[user].roles for user in names])
+        primaries = np.array([roles[user].primary for user in names])
+        remaining = np.arange(len(names))
+        games = []
+        while len(remaining) >= GAME_SIZE:
+            order = remaining[np.argsort(ratings[remaining], kind='stable')]
+            # lobbies are runs of players next to each other by mmr, scored on every split at once. when none of them
+            # work, runs of up to LEAVE_OUT more players are tried with that many of the players inside them left out, so
+            # a few players nobody can be matched with don't hold up everyone around them
+            for leave_out in range(min(LEAVE_OUT, len(order) - GAME_SIZE) + 1):
+                lobbies = sliding_window_view(order, GAME_SIZE + leave_out)[:, LOBBY_INDEX[leave_out]].reshape(-1, GAME_SIZE)
+                team1 = lobbies[:, SPLIT_INDEX]
+                team2 = lobbies[:, OTHER_INDEX]
+                difference = np.abs(ratings[team1].sum(axis=-1) - ratings[team2].sum(axis=-1))
+                spread = ratings[lobbies[:, -1]] - ratings[lobbies[:, 0]]
+                valid = valid_teams(masks[team1]) & valid_teams(masks[team2])
+                if waits is not None:
+                    # a lobby may be as uneven as its longest waiting player allows, and is scored against that allowance
+                    # so lobbies of players that have waited long go first
+                    allowed = allowed_gap(waits[lobbies].max(axis=1))
+                    valid &= difference / (GAME_SIZE // 2) <= allowed[:, None]
+                if valid.any():
+                    break
+            # the player who has waited the longest gets a game if there is one that works for them
+            has_first = (lobbies == remaining[0]).any(axis=1)
+            if (valid & has_first[:, None]).any():
+                valid &= has_first[:, None]
+            if not valid.any():
+                break
+            # teams where someone has to play off their primary role pay the penalty once for each of their players
+            off_role_teams = (~valid_teams(primaries[team1])).astype(int) + (~valid_teams(primaries[team2])).astype(int)
+            score = np.where(valid, difference + spread[:, None] + OFF_ROLE_PENALTY * (GAME_SIZE // 2) * off_role_teams, np.inf)
+            if waits is not None:
+                score = score / allowed[:, None]
+            lobby, split = np.unravel_index(np.argmin(score), score.shape)
+            blue_team = [names[i] for i in team1[lobby, split]]
+            red_team = [names[i] for i in team2[lobby, split]]
+            if random.random() < .5:
+                blue_team, red_team = red_team, blue_team
+            games.append((order_by_role(blue_team, roles), order_by_role(red_team, roles)))
+            remaining = remaining[~np.isin(remaining, lobbies[lobby])]
+        return games
+
+def splits(names):
+    # the first player always goes on the first team so every split is only seen once
+    for team in itertools.combinations(range(1, len(names)), len(names) // 2 - 1):
+        yield [names[0]] + [names[i] for i in team], [names[i] for i in range(1, len(names)) if i not in team]
+
+def order_by_role(team, roles, assignment=None):
+    if assignment is None:
+        assignment = team_roles(team, roles)
+        if assignment is None:
+            return list(team), None
+    order = sorted(range(len(team)), key=lambda i: assignment[i])
+    return [team[i] for i in order], [ROLES[assignment[i]] for i in order]
+
+def valid_teams(masks):
+    # masks has the role masks of a team in its last axis, every team is one lookup in the feasibility table
+    key = (np.sort(masks, axis=-1) << KEY_SHIFTS).sum(axis=-1)
+    return (feasible_table()[key >> 3] >> (key & 7) & 1).astype(bool)
 
 def is_valid_team(names, roles):
-    names = list(names)
-    random.shuffle(names)
-    for perm in itertools.permutations(names):
-        if (('top' in roles[perm[0]] or not roles[perm[0]]) and
-            ('jg' in roles[perm[1]] or not roles[perm[1]]) and
-            ('mid' in roles[perm[2]] or not roles[perm[2]]) and
-            ('bot' in roles[perm[3]] or not roles[perm[3]]) and
-            ('sup' in roles[perm[4]] or not roles[perm[4]])):
-            return True
-    return False
+    return assign_roles(tuple(roles[name].roles for name in names)) is not None
 
-def manual_game(team1, team2, team1_win: bool):
+async def manual_game(ratings, team1, team2, team1_win: bool):
     mmrs = {}
     for name in team1 + team2:
-        mmrs[name] = get_mmr(name)
+        mmrs[name] = await ratings.get_mmr(name)
 
     def team_mmr(team):
         total = 0
         for name in team:
             total += mmrs[name]
-        return total / 5
+        return total
 
-    game = Game(team1, team2, team_mmr(team1), team_mmr(team2))
-    game.update(team1_win)
+    game = Game(ratings, [Player(name) for name in team1], [Player(name) for name in team2], team_mmr(team1), team_mmr(team2))
+    await game.update(team1_win)
+    return game
 
@@ -1,6 +1,7 @@
-from discord import Color, Guild, Permissions, utils
-import time
+from discord import Color, Guild, Permissions
+import bisect
 import enum
+import os
 
 class Rank:
 
@@ -9,11 +10,13 @@ class Rank:
         LAST = enum.auto()
         ABSOLUTE = enum.auto()
 
-    def __init__(self, name, color, r, ordering=None) -> None:
+    def __init__(self, name, color, r, ordering=None, percentile=None) -> None:
         self.name = name
         self.color = color
         self.r = r
         self.ordering = ordering
+        # the percent of players below the rank when ranks are given by percentile
+        self.percentile = percentile
 
     def __lt__(self, other):
         match self.ordering:
@@ -34,59 +37,157 @@ class Rank:
                     return False
 
 CHALLENGED = Rank('Challenged', Color.from_rgb(255, 255, 255), range(-1, 0), Rank.Ordering.FIRST)
-IRON = Rank('Iron', Color.dark_gray(), range(0, 850), Rank.Ordering.ABSOLUTE)
-BRONZE = Rank('Bronze', Color.dark_orange(), range(850, 1050), Rank.Ordering.ABSOLUTE)
-SILVER = Rank('Silver', Color.light_gray(), range(1050, 1250), Rank.Ordering.ABSOLUTE)
-GOLD = Rank('Gold', Color.gold(), range(1250, 1450), Rank.Ordering.ABSOLUTE)
-PLATINUM = Rank('Platinum', Color.og_blurple(), range(1450, 1650), Rank.Ordering.ABSOLUTE)
-EMERALD = Rank('Emerald', Color.green(), range(1650, 1850), Rank.Ordering.ABSOLUTE)
-DIAMOND = Rank('Diamond', Color.blue(), range(1850, 9999999), Rank.Ordering.ABSOLUTE)
+IRON = Rank('Iron', Color.dark_gray(), range(0, 850), Rank.Ordering.ABSOLUTE, 0)
+BRONZE = Rank('Bronze', Color.dark_orange(), range(850, 1050), Rank.Ordering.ABSOLUTE, 5)
+SILVER = Rank('Silver', Color.light_gray(), range(1050, 1250), Rank.Ordering.ABSOLUTE, 20)
+GOLD = Rank('Gold', Color.gold(), range(1250, 1450), Rank.Ordering.ABSOLUTE, 45)
+PLATINUM = Rank('Platinum', Color.og_blurple(), range(1450, 1650), Rank.Ordering.ABSOLUTE, 70)
+EMERALD = Rank('Emerald', Color.green(), range(1650, 1850), Rank.Ordering.ABSOLUTE, 88)
+DIAMOND = Rank('Diamond', Color.blue(), range(1850, 9999999), Rank.Ordering.ABSOLUTE, 98)
 CHALLENGER = Rank('Challenger', Color.dark_purple(), range(-1, 0), Rank.Ordering.LAST)
 THE_BIG_CHUNGUS = Rank('The Big Chungus', Color.dark_purple(), range(-1, 0), Rank.Ordering.LAST)
 
 ALL_RANKS = [CHALLENGED, IRON, BRONZE, SILVER, GOLD, PLATINUM, EMERALD, DIAMOND, THE_BIG_CHUNGUS]
 
-def map_ranks(mmrs):
-    mmrs.sort(key=lambda x: x[1])
-    name_to_rank = {}
-    ranks_with_ranges = [rank for rank in ALL_RANKS if rank.ordering == Rank.Ordering.ABSOLUTE]
-    for name, mmr in mmrs:
-        for rank in ranks_with_ranges:
-            if int(mmr) in rank.r:
-                name_to_rank[name] = rank
+RANGED_RANKS = sorted(rank for rank in ALL_RANKS if rank.ordering == Rank.Ordering.ABSOLUTE)
+THRESHOLDS = [rank.r[0] for rank in RANGED_RANKS]
+PERCENTILES = [rank.percentile for rank in RANGED_RANKS]
+FIRST_RANK = next((rank for rank in ALL_RANKS if rank.ordering == Rank.Ordering.FIRST), None)
+LAST_RANK = next((rank for rank in ALL_RANKS if rank.ordering == Rank.Ordering.LAST), None)
+
+def ranged_rank(mmr):
+    return RANGED_RANKS[max(bisect.bisect_right(THRESHOLDS, int(mmr)) - 1, 0)]
+
+def percentiles():
+    # RANK_TIERS=percentile gives ranks by where players stand among everyone instead of by fixed mmr ranges
+    return PERCENTILES if os.getenv('RANK_TIERS') == 'percentile' else None
+
+def mmr_of(entry):
+    return entry[0]
+
+class RankIndex:
+    # players kept sorted by mmr so the lowest, highest and any one player's rank are cheap to find, and so is the number of
+    # players below anyone, which is all a percentile rank needs
+    def __init__(self, mmrs, percentiles=None) -> None:
+        self.mmrs = dict(mmrs)
+        self.order = sorted((mmr, name) for name, mmr in self.mmrs.items())
+        self.percentiles = percentiles
+        self.cutoffs = []
+        self.update_cutoffs()
+
+    def __contains__(self, name):
+        return name in self.mmrs
+
+    def __len__(self):
+        return len(self.order)
+
+    def lowest(self):
+        return self.order[0][1] if self.order else None
+
+    def highest(self):
+        return self.order[-1][1] if self.order else None
+
+    def update_cutoffs(self):
+        # how many players have to be below someone for each ranged rank, rounded up so the top few percent is never more
+        # than a few percent. players on the same mmr count the same players below them, so ties always share a rank
+        if self.percentiles:
+            self.cutoffs = [-(-percentile * len(self.order) // 100) for percentile in self.percentiles]
+
+    def below(self, mmr):
+        # (mmr,) sorts before every (mmr, name)
+        return bisect.bisect_left(self.order, (mmr,))
+
+    def ranged_rank(self, mmr):
+        if not self.percentiles:
+            return ranged_rank(mmr)
+        return RANGED_RANKS[max(bisect.bisect_right(self.cutoffs, self.below(mmr)) - 1, 0)]
+
+    def rank(self, name):
+        if FIRST_RANK and name == self.lowest():
+            return FIRST_RANK
+        if LAST_RANK and name == self.highest():
+            return LAST_RANK
+        return self.ranged_rank(self.mmrs[name])
+
+    def near(self, positions, distance):
+        # everyone within distance places of the positions, and everyone tied with them
+        names = set()
+        for position in positions:
+            if not self.order:
                 break
-    if Rank.Ordering.FIRST in [rank.ordering for rank in ALL_RANKS]:
-        name_to_rank[mmrs[0][0]] = next(rank for rank in ALL_RANKS if rank.ordering == Rank.Ordering.FIRST)
-    if Rank.Ordering.LAST in [rank.ordering for rank in ALL_RANKS]:
-        name_to_rank[mmrs[-1][0]] = next(rank for rank in ALL_RANKS if rank.ordering == Rank.Ordering.LAST)
-    return name_to_rank
+            low = self.order[max(position - distance, 0)][0]
+            high = self.order[min(position + distance, len(self.order) - 1)][0]
+            names.update(name for _, name in self.order[self.below(low):bisect.bisect_right(self.order, high, key=mmr_of)])
+        return names
+
+    def boundaries(self, moved):
+        # the only players whose rank can change without their own mmr changing. moving a player shifts everyone else by at
+        # most one place and so does a new player, whose arrival also moves each cutoff by at most one place, so anyone
+        # crossing the lowest, the highest or a cutoff must have been within moved + 1 places of it
+        positions = [0, len(self.order) - 1] + (self.cutoffs if self.percentiles else [])
+        return self.near(positions, moved + 1)
+
+    def map(self):
+        return {name: self.rank(name) for name in self.mmrs}
+
+    def update(self, new_mmrs):
+        # returns name -> (old rank, new rank) for every player whose rank changed, None for a new player's old rank
+        affected = set(new_mmrs) | self.boundaries(len(new_mmrs))
+        old_ranks = {name: self.rank(name) for name in affected if name in self.mmrs}
+        for name, mmr in new_mmrs.items():
+            if name in self.mmrs:
+                del self.order[bisect.bisect_left(self.order, (self.mmrs[name], name))]
+            self.mmrs[name] = mmr
+            bisect.insort(self.order, (mmr, name))
+        self.update_cutoffs()
+        changes = {}
+        for name in affected:
+            new_rank = self.rank(name)
+            if old_ranks.get(name) is not new_rank:
+                changes[name] = (old_ranks.get(name), new_rank)
+        return changes
+
+    def rename(self, old_name, name):
+        mmr = self.mmrs.pop(old_name)
+        del self.order[bisect.bisect_left(self.order, (mmr, old_name))]
+        self.mmrs[name] = mmr
+        bisect.insort(self.order, (mmr, name))
+
+    def apply(self, deltas):
+        return self.update({name: self.mmrs[name] + delta for name, delta in deltas.items()})
+
+def map_ranks(mmrs, percentiles=None):
+    return RankIndex(mmrs, percentiles).map()
 
 async def startup(guild: Guild):
+    # brings the rank roles in line with ALL_RANKS, only calling the api for what is actually missing or wrong, and gives
+    # (api calls made, api calls saved) against deleting and recreating every role
+    calls = 0
+    roles = {}
     for role in guild.roles:
-        if  role.name != 'matchmaking bot' and role.name in [rank.name for rank in ALL_RANKS]:
-            await role.delete()
-            time.sleep(.05)
-    default_role = utils.get(guild.roles, name='@everyone')
-    if default_role:
-        perms = default_role.permissions
-    else:
-        perms = Permissions.membership()
-    for rank in ALL_RANKS:
-        if rank not in guild.roles:
-            await guild.create_role(name=rank.name, color=rank.color, hoist=True, mentionable=True, permissions=perms)
-            time.sleep(.05)
-    first_open = 1
+        if role.name in [rank.name for rank in ALL_RANKS]:
+            roles.setdefault(role.name, []).append(role)
     rank_to_role = {}
-    for role in guild.roles:
-        for rank in ALL_RANKS:
-            if role.name == rank.name:
-                rank_to_role[rank] = role
-                break
-    positions = {}
-    for rank in sorted(ALL_RANKS):
-        positions[rank_to_role[rank]] = first_open
-        first_open +=1
-    # bot_role = utils.get(guild.roles, name='matchmaking bot')
-    # positions[bot_role] = first_open
-    await guild.edit_role_positions(positions)
-    
+    for rank in ALL_RANKS:
+        if existing := roles.get(rank.name):
+            # duplicates from older startups are dropped, keeping the one most members already have
+            keep = max(existing, key=lambda role: len(role.members))
+            for role in existing:
+                if role is not keep:
+                    await role.delete()
+                    calls += 1
+            if keep.color != rank.color:
+                keep = await keep.edit(color=rank.color) or keep
+                calls += 1
+            rank_to_role[rank] = keep
+        else:
+            default_role = guild.default_role
+            perms = default_role.permissions if default_role else Permissions.membership()
+            rank_to_role[rank] = await guild.create_role(name=rank.name, color=rank.color, hoist=True, mentionable=True, permissions=perms)
+            calls += 1
+    ordered = [rank_to_role[rank] for rank in sorted(ALL_RANKS)]
+    if any(a.position >= b.position for a, b in zip(ordered, ordered[1:])):
+        await guild.edit_role_positions({role: position for position, role in enumerate(ordered, 1)})
+        calls += 1
+    teardown = sum(len(existing) for existing in roles.values()) + len(ALL_RANKS) + 1
+    return calls, teardown - calls
@@ -0,0 +1,189 @@
+import math
+import os
+import numpy as np
+
+# ratings are held in arrays indexed by player, and a batch of games is a pair of (games, 5) index arrays into them
+# plus whether blue won each one, so every game in a rating period is rated at once
+
+class Elo:
+    # fixed k, teams are compared by average mmr and everyone on a team gets the same change
+    def __init__(self, k=100, start=1200) -> None:
+        self.k = k
+        self.start = start
+        self.start_rd = 0
+        self.start_vol = 0
+
+    def expected(self, blue_mmrs, red_mmrs):
+        return 1 / (1 + 10 ** ((np.mean(red_mmrs, axis=-1) - np.mean(blue_mmrs, axis=-1)) / 400))
+
+    def rate(self, mmr, rd, vol, blue, red, blue_win):
+        change = self.k * (blue_win - self.expected(mmr[blue], mmr[red]))
+        new_mmr = mmr.copy()
+        np.add.at(new_mmr, blue, change[:, None])
+        np.add.at(new_mmr, red, -change[:, None])
+        return new_mmr, rd, vol
+
+    def rate_each(self, mmr, blue, red, blue_win):
+        # the games one after another on plain floats, gives the new mmr and every game's players' mmr before it and
+        # change, blue then red
+        mmr = mmr.tolist()
+        before = []
+        change = []
+        for blue_players, red_players, won in zip(blue.tolist(), red.tolist(), blue_win.tolist()):
+            game = blue_players + red_players
+            before.append([mmr[i] for i in game])
+            red_mean = sum(mmr[i] for i in red_players) / len(red_players)
+            blue_mean = sum(mmr[i] for i in blue_players) / len(blue_players)
+            blue_change = self.k * (won - 1 / (1 + 10 ** ((red_mean - blue_mean) / 400)))
+            for i in blue_players:
+                mmr[i] += blue_change
+            for i in red_players:
+                mmr[i] -= blue_change
+            change.append(blue_change)
+        side = np.repeat([1, -1], blue.shape[1])
+        return np.array(mmr), np.array(before).reshape(-1, 2 * blue.shape[1]), np.outer(change, side)
+
+SCALE = 173.7178
+
+class Glicko2:
+    # each player is rated against the other team as one opponent with the team's average rating and deviation
+    def __init__(self, start=1200, start_rd=350, start_vol=.06, tau=.5) -> None:
+        self.start = start
+        self.start_rd = start_rd
+        self.start_vol = start_vol
+        self.tau = tau
+
+    @staticmethod
+    def g(phi):
+        return 1 / np.sqrt(1 + 3 * phi ** 2 / math.pi ** 2)
+
+    def expected(self, blue_mmrs, red_mmrs, red_rds=None):
+        mu = (np.mean(blue_mmrs, axis=-1) - np.mean(red_mmrs, axis=-1)) / SCALE
+        phi = 0 if red_rds is None else np.sqrt(np.mean(np.square(red_rds), axis=-1)) / SCALE
+        return 1 / (1 + np.exp(-self.g(phi) * mu))
+
+    def rate(self, mmr, rd, vol, blue, red, blue_win):
+        mu = (mmr - self.start) / SCALE
+        phi = rd / SCALE
+        # every player in every game against the composite of the team they played
+        players = np.concatenate([blue, red]).ravel()
+        opponents = np.concatenate([red, blue])
+        score = np.concatenate([blue_win, 1 - blue_win]).astype(float).repeat(blue.shape[1])
+        opponent_mu = mu[opponents].mean(axis=1).repeat(blue.shape[1])
+        opponent_phi = np.sqrt(np.square(phi[opponents]).mean(axis=1)).repeat(blue.shape[1])
+        g = self.g(opponent_phi)
+        e = 1 / (1 + np.exp(-g * (mu[players] - opponent_mu)))
+        information = np.zeros(len(mmr))
+        improvement = np.zeros(len(mmr))
+        np.add.at(information, players, g ** 2 * e * (1 - e))
+        np.add.at(improvement, players, g * (score - e))
+        played = information > 0
+        v = np.divide(1, information, out=np.full(len(mmr), np.inf), where=played)
+        delta = np.where(played, v * improvement, 0)
+        new_vol = np.where(played, self.volatility(phi, vol, v, delta, played), vol)
+        phi_star = np.sqrt(phi ** 2 + new_vol ** 2)
+        # players that sat out the period are left as they were
+        new_phi = np.where(played, 1 / np.sqrt(1 / phi_star ** 2 + information), phi)
+        new_mu = mu + new_phi ** 2 * improvement
+        return new_mu * SCALE + self.start, new_phi * SCALE, new_vol
+
+    def volatility(self, phi, vol, v, delta, played):
+        # the illinois iteration from the glicko-2 paper, run on every player at once
+        v = np.where(played, v, 1)
+        alpha = np.log(vol ** 2)
+        def f(x):
+            ex = np.exp(x)
+            return ex * (delta ** 2 - phi ** 2 - v - ex) / (2 * (phi ** 2 + v + ex) ** 2) - (x - alpha) / self.tau ** 2
+        big = delta ** 2 > phi ** 2 + v
+        a = alpha
+        b = np.where(big, np.log(np.maximum(delta ** 2 - phi ** 2 - v, 1e-300)), alpha - self.tau)
+        if (~big).any():
+            k = np.ones(len(vol))
+            while (bad := ~big & (f(alpha - k * self.tau) < 0)).any():
+                k = np.where(bad, k + 1, k)
+            b = np.where(big, b, alpha - k * self.tau)
+        fa, fb = f(a), f(b)
+        for _ in range(100):
+            active = np.abs(b - a) > 1e-6
+            if not active.any():
+                break
+            c = np.where(active, a + (a - b) * fa / np.where(active, fb - fa, 1), b)
+            fc = f(c)
+            crossed = active & (fc * fb <= 0)
+            a, fa = np.where(crossed, b, a), np.where(crossed, fb, np.where(active, fa / 2, fa))
+            b, fb = c, fc
+        return np.exp(a / 2)
+
+ENGINES = {'elo': Elo, 'glicko2': Glicko2}
+
+def engine(name=None, **kwargs):
+    return ENGINES[name or os.getenv('RATING_ENGINE', 'elo')](**kwargs)
+
+def replay(engine, games, period=None, history=None, seeds=None):
+    # games are (time, blue names, red names, blue win) in order, rated one at a time or in periods of `period` seconds.
+    # given a dict, history gets the arrays the games were rated from: 'names', 'players' with every game's blue then red
+    # players as indexes into names, 'blue_win', and 'mmr' and 'change' shaped like players with what each player had before
+    # the game and what it changed by, where games rated in the same period share the period's change. seeds are
+    # name -> (mmr, wins, losses) that players start from instead of nothing, for what they earned before the log was kept.
+    # a seed without games before the log holds no mmr of its own, so those players start where the engine does
+    seeds = seeds or {}
+    index = {name: i for i, name in enumerate(seeds)}
+    def players(names):
+        return [index.setdefault(name, len(index)) for name in names]
+    # an engine that can rate games one after another on its own does, since batching games that each depend on the last
+    # costs more than it saves
+    one_by_one = period is None and hasattr(engine, 'rate_each')
+    blue, red, blue_win = [], [], []
+    # batches are lists of games, and the batch each player was last rated in
+    batches = []
+    last = {}
+    key = None
+    for n, (time, blue_names, red_names, won) in enumerate(games):
+        blue.append(players(blue_names))
+        red.append(players(red_names))
+        blue_win.append(won)
+        if one_by_one:
+            continue
+        if period is None:
+            # a game only depends on its players' earlier games, so it goes in the batch after the last one any of them
+            # played in. rating the batches in order is the same as rating the games in order, in as many batches as the
+            # longest chain of games linked by a shared player
+            level = max(last.get(i, -1) for i in blue[-1] + red[-1]) + 1
+            last.update((i, level) for i in blue[-1] + red[-1])
+        else:
+            level = len(batches) - (bool(batches) and key == int(time // period))
+            key = int(time // period)
+        if level == len(batches):
+            batches.append([])
+        batches[level].append(n)
+    blue = np.array(blue, dtype=int).reshape(-1, 5)
+    red = np.array(red, dtype=int).reshape(-1, 5)
+    blue_win = np.array(blue_win, dtype=bool)
+    mmr = np.full(len(index), float(engine.start))
+    mmr[:len(seeds)] = [seed[0] if seed[1] + seed[2] else engine.start for seed in seeds.values()]
+    rd = np.full(len(index), float(engine.start_rd))
+    vol = np.full(len(index), float(engine.start_vol))
+    before = np.zeros((len(blue), 10))
+    change = np.zeros((len(blue), 10))
+    if one_by_one:
+        mmr, before, change = engine.rate_each(mmr, blue, red, blue_win)
+    for batch in batches:
+        # only the players in the batch are rated, on arrays of just them
+        batch = np.array(batch)
+        played, local = np.unique(np.concatenate([blue[batch], red[batch]]), return_inverse=True)
+        local = local.reshape(2 * len(batch), -1)
+        old = mmr[played]
+        mmr[played], rd[played], vol[played] = engine.rate(mmr[played], rd[played], vol[played],
+                                                           local[:len(batch)], local[len(batch):], blue_win[batch].astype(float))
+        if history is not None:
+            order = np.concatenate([local[:len(batch)], local[len(batch):]], axis=1)
+            before[batch] = old[order]
+            change[batch] = (mmr[played] - old)[order]
+    wins = np.bincount(np.concatenate([blue[blue_win], red[~blue_win]]).ravel(), minlength=len(index))
+    losses = np.bincount(np.concatenate([blue[~blue_win], red[blue_win]]).ravel(), minlength=len(index))
+    wins[:len(seeds)] += np.array([seed[1] for seed in seeds.values()], dtype=int)
+    losses[:len(seeds)] += np.array([seed[2] for seed in seeds.values()], dtype=int)
+    if history is not None:
+        history.update(names=list(index), players=np.concatenate([blue, red], axis=1), blue_win=blue_win, mmr=before,
+                       change=change)
+    return {name: (mmr[i], rd[i], vol[i], wins[i], losses[i]) for name, i in index.items()}
@@ -0,0 +1,50 @@
+import discord
+
+READY_TIMEOUT = 60
+
+class ReadyCheck(discord.ui.View):
+    # accept/decline buttons under a matched game, only the game's players can press them and it stops as soon as
+    # everyone accepted, anyone declined or the timeout ran out
+    def __init__(self, game, timeout=READY_TIMEOUT) -> None:
+        super().__init__(timeout=timeout)
+        self.players = {user.id: user for user in game.blue_team + game.red_team if getattr(user, 'id', None) is not None}
+        # players without an id were restored after leaving the guild and can never accept
+        self.unreachable = [user for user in game.blue_team + game.red_team if getattr(user, 'id', None) is None]
+        self.size = len(game.blue_team) + len(game.red_team)
+        self.accepted = set()
+        self.declined = set()
+        self.update_label()
+
+    def missing(self):
+        return [user for id, user in self.players.items() if id not in self.accepted] + self.unreachable
+
+    def dropped(self, timed_out):
+        # a decline only costs the players that declined, running out of time costs everyone that hadn't accepted yet
+        if timed_out:
+            return self.missing()
+        return [self.players[id] for id in self.declined] + self.unreachable
+
+    def update_label(self):
+        self.accept.label = f'Accept ({len(self.accepted)}/{self.size})'
+
+    async def interaction_check(self, interaction):
+        if interaction.user.id not in self.players:
+            await interaction.response.send_message('you are not in this game', ephemeral=True)
+            return False
+        return True
+
+    @discord.ui.button(label='Accept', style=discord.ButtonStyle.green)
+    async def accept(self, interaction, _):
+        self.accepted.add(interaction.user.id)
+        self.declined.discard(interaction.user.id)
+        self.update_label()
+        await interaction.response.edit_message(view=self)
+        if not self.missing():
+            self.stop()
+
+    @discord.ui.button(label='Decline', style=discord.ButtonStyle.red)
+    async def decline(self, interaction, _):
+        self.declined.add(interaction.user.id)
+        self.accepted.discard(interaction.user.id)
+        await interaction.response.defer()
+        self.stop()
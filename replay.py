@@ -0,0 +1,55 @@
+import argparse
+import time
+import mmr
+import rating
+from database import Database
+
+def main():
+    parser = argparse.ArgumentParser(description='rebuilds the mmr table by replaying the game log',
+                                     epilog='a running bot keeps its old ratings in memory until !replay is used or it restarts')
+    parser.add_argument('db', nargs='?', default='bot.db')
+    parser.add_argument('--engine', choices=list(rating.ENGINES), default=None, help='defaults to RATING_ENGINE or elo')
+    parser.add_argument('--k', type=float, help='k for elo')
+    parser.add_argument('--start', type=float, help='rating new players start at')
+    parser.add_argument('--period', type=float, help='rate games in periods of this many hours instead of one at a time')
+    parser.add_argument('--flip', type=int, nargs='*', default=[], help='ids of games whose winner was reported wrong')
+    parser.add_argument('--void', type=int, nargs='*', default=[], help='ids of games that should not count')
+    parser.add_argument('--top', type=int, default=20, help='how many of the biggest changes to show')
+    parser.add_argument('--write', action='store_true', help='save the fixes and the new ratings, otherwise only show the diff')
+    args = parser.parse_args()
+
+    kwargs = {}
+    if args.k is not None:
+        kwargs['k'] = args.k
+    if args.start is not None:
+        kwargs['start'] = args.start
+    engine = rating.engine(args.engine, **kwargs)
+    conn = Database(args.db, mmr.MIGRATIONS).connect()
+    conn.execute('BEGIN')
+    for game_id in args.flip:
+        conn.execute('''INSERT INTO fixes (game_id, time, blue_win)
+                        SELECT id, ?, 1 - IFNULL((SELECT blue_win FROM fixes WHERE game_id = games.id ORDER BY id DESC LIMIT 1), blue_win)
+                        FROM games WHERE id = ?''', (time.time(), game_id))
+    for game_id in args.void:
+        conn.execute('INSERT INTO fixes (game_id, time, blue_win) SELECT id, ?, NULL FROM games WHERE id = ?', (time.time(), game_id))
+
+    old = {name: mmr for name, mmr in conn.execute('SELECT name, mmr FROM mmr')}
+    start = time.perf_counter()
+    games, results, history = mmr.replay_log(conn, engine, args.period * 3600 if args.period else None)
+    elapsed = time.perf_counter() - start
+    new = {name: engine.start for name in old} | {name: float(result[0]) for name, result in results.items()}
+
+    print(f'replayed {len(games)} games for {len(results)} players in {elapsed:.2f}s')
+    changes = sorted(new, key=lambda name: abs(new[name] - old.get(name, engine.start)), reverse=True)
+    for name in changes[:args.top]:
+        print(f'{name:<32}{old.get(name, engine.start):>8.0f} -> {new[name]:>5.0f} ({new[name] - old.get(name, engine.start):+.0f})')
+    if args.write:
+        mmr.write_ratings(conn, engine, results)
+        mmr.write_history(conn, games, history)
+        conn.execute('COMMIT')
+        print('mmr table and game history rewritten')
+    else:
+        conn.execute('ROLLBACK')
+
+if __name__ == '__main__':
+    main()
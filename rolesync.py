@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import discord
+import metrics
+import ranks
+
+_log = logging.getLogger(__name__)
+
+class RoleSync:
+    # keeps members' rank roles in line with their ranks, only calling discord for members that are wrong
+    def __init__(self, guild: discord.Guild, resolve, concurrency=4, interval=.05) -> None:
+        self.guild = guild
+        self.resolve = resolve
+        self.concurrency = concurrency
+        self.interval = interval
+        self.pending = {}
+        self.queue = asyncio.Queue()
+        self.workers = set()
+
+    def managed_roles(self):
+        names = [rank.name for rank in ranks.ALL_RANKS]
+        return {role.name: role for role in self.guild.roles if role.name in names}
+
+    def sync(self, name_to_rank):
+        roles = self.managed_roles()
+        queued = 0
+        for name, rank in name_to_rank.items():
+            if not (member := self.resolve(name)):
+                continue
+            target = roles.get(rank.name)
+            current = [role for role in member.roles if role.name in roles]
+            if current != ([target] if target else []):
+                self.submit(member, target)
+                queued += 1
+        return queued
+
+    def submit(self, member, role):
+        # a member that is already waiting keeps their place and just gets the newest role
+        if member.id not in self.pending:
+            self.queue.put_nowait(member.id)
+        self.pending[member.id] = (member, role)
+        while len(self.workers) < min(self.concurrency, self.queue.qsize()):
+            self.workers.add(asyncio.create_task(self.work()))
+
+    async def join(self):
+        await self.queue.join()
+
+    async def work(self):
+        try:
+            while not self.queue.empty():
+                member_id = self.queue.get_nowait()
+                member, role = self.pending.pop(member_id)
+                try:
+                    await self.apply(member, role)
+                except discord.RateLimited as err:
+                    metrics.count('discord_rate_limits_total', source='role_sync')
+                    await self.retry(member, role, err.retry_after)
+                except discord.HTTPException as err:
+                    if err.status == 429:
+                        metrics.count('discord_rate_limits_total', source='role_sync')
+                        await self.retry(member, role, float(err.response.headers.get('Retry-After', 1)))
+                    else:
+                        _log.error('could not sync roles for %s', member, exc_info=err)
+                finally:
+                    self.queue.task_done()
+                await asyncio.sleep(self.interval)
+        finally:
+            self.workers.discard(asyncio.current_task())
+
+    async def retry(self, member, role, delay):
+        await asyncio.sleep(delay)
+        if member.id not in self.pending:
+            self.submit(member, role)
+
+    async def apply(self, member, role):
+        managed = self.managed_roles().values()
+        remove = [managed_role for managed_role in member.roles if managed_role in managed and managed_role != role]
+        if remove:
+            metrics.count('discord_api_calls_total', call='remove_roles')
+            await member.remove_roles(*remove)
+        if role and role not in member.roles:
+            metrics.count('discord_api_calls_total', call='add_roles')
+            await member.add_roles(role)
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+import discord
+import metrics
+
+_log = logging.getLogger(__name__)
+
+DEBOUNCE = 1.5
+
+class QueueStatus:
+    # one message per channel showing the queue, edited in place. every change in the debounce window after the first one
+    # goes out in the same edit, so a rush of joins costs one edit instead of a message each
+    def __init__(self, channel, render, delay=DEBOUNCE) -> None:
+        self.channel = channel
+        self.render = render
+        self.delay = delay
+        self.message = None
+        self.note = None
+        self.flusher = None
+        self.dirty = False
+
+    def touch(self, note=None):
+        self.note = note
+        self.dirty = True
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        # changes made while an edit is in flight get one more edit after another debounce window
+        try:
+            while self.dirty:
+                await asyncio.sleep(self.delay)
+                self.dirty = False
+                await self.publish()
+        finally:
+            self.flusher = None
+
+    async def publish(self):
+        content = discord.utils.escape_markdown(self.render())
+        if self.note:
+            content += '\n' + self.note
+        try:
+            if self.message:
+                try:
+                    metrics.count('discord_api_calls_total', call='queue_status_edit')
+                    await self.message.edit(content=content)
+                    return
+                except discord.NotFound:
+                    self.message = None
+            metrics.count('discord_api_calls_total', call='queue_status_send')
+            self.message = await self.channel.send(content)
+        except discord.HTTPException as err:
+            _log.error('could not update the queue status in %s', self.channel, exc_info=err)